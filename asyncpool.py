@@ -0,0 +1,54 @@
+import asyncio
+import logging
+
+
+class MyAsyncPool():
+    """协程任务池，按任务类型限制同时运行的协程数
+
+    limits格式: {任务类型: 并发数}，例如 {'comic': 5, 'chapter': 10, 'img': 100}
+    需要在事件循环中创建和使用
+    """
+
+    def __init__(self, limits: dict) -> None:
+        self.limits = limits
+        self._semaphores = {k: asyncio.Semaphore(v) for k, v in limits.items()}
+        self.tasks: set[asyncio.Task] = set()
+        self._wroking = True
+
+    def add_task(self, _type: str, func, *args, **kwargs) -> asyncio.Task | None:
+        if self._wroking:
+            task = asyncio.create_task(self._run(_type, func, *args, **kwargs))
+            self.tasks.add(task)
+            return task
+        return None
+
+    async def _run(self, _type: str, func, *args, **kwargs):
+        async with self._semaphores[_type]:
+            return await func(*args, **kwargs)
+
+    def max_tasks(self) -> int:
+        """所有任务类型并发数之和
+        """
+        return sum(self.limits.values())
+
+    async def wait(self, timeout: float | None = None, logger: logging.Logger | None = None,
+                   return_when: str = asyncio.ALL_COMPLETED) -> set[asyncio.Task]:
+        """等待任务完成，返回已完成的任务
+        """
+        if not self.tasks:
+            return set()
+        done, _ = await asyncio.wait(self.tasks, timeout=timeout, return_when=return_when)
+        for task in done:
+            if not task.cancelled():
+                e = task.exception()
+                if e and logger:
+                    logger.error(e)
+            self.tasks.discard(task)
+        return done
+
+    async def close(self):
+        self._wroking = False
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
@@ -1,14 +1,112 @@
+import time
 from io import BytesIO
+from threading import Lock
+from urllib.parse import urlparse
 
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
 from curl_cffi import requests as cffi_requests
 from PIL import Image, UnidentifiedImageError
 
+from ratelimit import RateLimiter, TokenBucket
+from metrics import DOWNLOAD_BYTES, REQUESTS, REQUEST_SECONDS
+
 
 class RequestError(Exception):
-    """ 请求错误 """
-    pass
+    """ 请求错误，status_code是响应的状态码 """
+
+    def __init__(self, msg: str = '', status_code: int = None) -> None:
+        super().__init__(msg)
+        self.status_code = status_code
+
+
+class SessionPool:
+    """按host复用的会话池，线程安全
+
+    同一个host共用一个会话，保持长连接，避免每次请求都重新进行TCP和TLS握手。
+    requests会话通过HTTPAdapter设置连接池大小；
+    curl_cffi会话内部每个线程使用独立的curl句柄，每个线程各自保持连接。
+    """
+
+    def __init__(self, pool_size: int = 10) -> None:
+        self.pool_size = pool_size
+        self._lock = Lock()
+        self._sessions: dict[str, requests.Session] = {}
+        self._tsl_sessions: dict[str, cffi_requests.Session] = {}
+
+    @staticmethod
+    def _host(url: str) -> str:
+        parsed = urlparse(url)
+        return f'{parsed.scheme}://{parsed.netloc}'
+
+    def get_session(self, url: str) -> requests.Session:
+        """获取url对应host的requests会话
+        """
+        host = self._host(url)
+        with self._lock:
+            session = self._sessions.get(host, None)
+            if not session:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session.mount(host, adapter)
+                self._sessions[host] = session
+            return session
+
+    def get_tsl_session(self, url: str) -> cffi_requests.Session:
+        """获取url对应host的curl_cffi会话
+        """
+        host = self._host(url)
+        with self._lock:
+            session = self._tsl_sessions.get(host, None)
+            if not session:
+                session = cffi_requests.Session()
+                self._tsl_sessions[host] = session
+            return session
+
+    def set_pool_size(self, pool_size: int):
+        """修改连接池大小，已创建的会话会被关闭，下次请求时重新创建
+        """
+        if pool_size == self.pool_size:
+            return
+        self.pool_size = pool_size
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            for session in self._tsl_sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._tsl_sessions.clear()
+
+
+session_pool = SessionPool()
+rate_limiter = RateLimiter()
+
+
+def limit_feedback(bucket: TokenBucket | None, status_code: int | None):
+    """根据请求结果调整限速，status_code为None表示请求发生异常
+    """
+    if not bucket:
+        return
+    if status_code is None or RateLimiter.is_throttle(status_code):
+        bucket.on_throttle()
+    else:
+        bucket.on_success()
+
+
+def record_request(limit_type: str | None, start: float, status_code: int | None, size: int = 0):
+    """记录请求耗时、状态码和下载字节数，status_code为None表示请求发生异常
+    """
+    _type = limit_type or 'other'
+    REQUEST_SECONDS.observe(time.perf_counter() - start, _type)
+    REQUESTS.inc(1, _type, 'error' if status_code is None else status_code)
+    if size:
+        DOWNLOAD_BYTES.inc(size, _type)
+
 
 class Crawler:
     def __init__(self,
@@ -16,32 +114,48 @@ class Crawler:
                  cookies:dict=None,
                  headers:dict=None,
                  params:dict=None,
+                 limit_type:str=None,
                  ) -> None:
         self.url = url
         self.cookies=cookies
         self.headers=headers
         self.params=params
+        self.limit_type=limit_type  # 限速的请求类型，None不限速
 
     def get(self) -> Response:
-        response = requests.get(self.url, 
-                                params=self.params, 
-                                cookies=self.cookies, 
-                                headers=self.headers,
-                                )
+        bucket = rate_limiter.get_bucket(self.url, self.limit_type) if self.limit_type else None
+        if bucket:
+            bucket.acquire()
+        session = session_pool.get_session(self.url)
+        start = time.perf_counter()
+        try:
+            response = session.get(self.url, 
+                                    params=self.params, 
+                                    cookies=self.cookies, 
+                                    headers=self.headers,
+                                    )
+        except Exception:
+            limit_feedback(bucket, None)
+            record_request(self.limit_type, start, None)
+            raise
+        limit_feedback(bucket, response.status_code)
+        record_request(self.limit_type, start, response.status_code, len(response.content))
         if response.status_code == 200:
             return response
-        return None
+        raise RequestError(f'请求失败 [url]:{self.url}, [status_code]:{response.status_code}',
+                           response.status_code)
 
 
 class HtmlCrawler(Crawler):
 
-    def get(self, save_file:str) -> bool:
+    def get(self, save_file:str=None) -> bytes:
+        """请求网页，返回网页原始数据，提供save_file时同时保存到文件，用于调试
+        """
         response = super().get()
-        if response:
-            with open(save_file, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-                return True
-        return False
+        if save_file:
+            with open(save_file, 'wb') as f:
+                f.write(response.content)
+        return response.content
     
 
 class WebpCrawler(Crawler):
@@ -71,50 +185,149 @@ class TSLCrawler:
                  headers:dict=None,
                  params:dict=None,
                  proxies:dict=None,
+                 limit_type:str=None,
                  ) -> None:
         self.url = url
         self.cookies=cookies
         self.headers=headers
         self.params=params
         self.proxies=proxies
+        self.limit_type=limit_type  # 限速的请求类型，None不限速
+
+    def get_bucket(self) -> TokenBucket | None:
+        if self.limit_type:
+            return rate_limiter.get_bucket(self.url, self.limit_type)
+        return None
 
     def get(self) -> Response:
-        response = cffi_requests.get(self.url, 
-                                params=self.params, 
-                                cookies=self.cookies, 
-                                headers=self.headers,
-                                proxies=self.proxies,
-                                timeout=60,
-                                impersonate=cffi_requests.BrowserType.chrome
-                                )
+        bucket = self.get_bucket()
+        if bucket:
+            bucket.acquire()
+        session = session_pool.get_tsl_session(self.url)
+        start = time.perf_counter()
+        try:
+            response = session.get(self.url, 
+                                    params=self.params, 
+                                    cookies=self.cookies, 
+                                    headers=self.headers,
+                                    proxies=self.proxies,
+                                    timeout=60,
+                                    impersonate=cffi_requests.BrowserType.chrome
+                                    )
+        except Exception:
+            limit_feedback(bucket, None)
+            record_request(self.limit_type, start, None)
+            raise
+        limit_feedback(bucket, response.status_code)
+        record_request(self.limit_type, start, response.status_code, len(response.content))
         if response.status_code == 200:
             return response
-        return None
+        raise RequestError(f'请求失败 [url]:{self.url}, [status_code]:{response.status_code}',
+                           response.status_code)
     
 class HtmlTSLCrawler(TSLCrawler):
-    def get(self, save_file:str) -> bool:
+    def get(self, save_file:str=None) -> bytes:
+        """请求网页，返回网页原始数据，提供save_file时同时保存到文件，用于调试
+        """
         response = super().get()
-        if response:
-            with open(save_file, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-                return True
-        return False
+        if save_file:
+            with open(save_file, 'wb') as f:
+                f.write(response.content)
+        return response.content
     
 class ImgTSLCrawler(TSLCrawler):
 
-    def get(self, save_file:str) -> bool:
+    def get(self) -> bytes:
+        """请求图片，返回图片原始数据，转码和保存由JMImgHandle.save_img处理
+        """
         response = super().get()
         if response and (r'image/' in response.headers.get('Content-Type', '')):
-            try:
-                # 图片转jpg
-                with Image.open(BytesIO(response.content)) as img:
-                    jpg_img = img.convert('RGB')
-                    jpg_img.save(save_file)
-                    return True
-            except UnidentifiedImageError:
-                # 请求成功，但是数据有问题，就创建一个像素的图片
-                img = Image.new('RGB', (1, 1), color = (255, 255, 255))
-                img.save(save_file)
-                return True
+            return response.content
+        else:
+            raise TypeError(f'响应数据类型不是图. Content-Type:{response.headers.get("Content-Type", "")}')
+
+
+class AsyncSessionPool:
+    """按host复用的异步会话池
+
+    只能在创建会话的事件循环中使用，事件循环结束前需要调用close
+    """
+
+    def __init__(self, max_clients: int = 100) -> None:
+        self.max_clients = max_clients
+        self._sessions: dict[str, cffi_requests.AsyncSession] = {}
+
+    def get_session(self, url: str) -> cffi_requests.AsyncSession:
+        host = SessionPool._host(url)
+        session = self._sessions.get(host, None)
+        if not session:
+            session = cffi_requests.AsyncSession(max_clients=self.max_clients)
+            self._sessions[host] = session
+        return session
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+class AsyncTSLCrawler(TSLCrawler):
+    """TSLCrawler的协程版本，需要提供AsyncSessionPool
+    """
+
+    def __init__(self,
+                 url:str,
+                 sessions:AsyncSessionPool,
+                 cookies:dict=None,
+                 headers:dict=None,
+                 params:dict=None,
+                 proxies:dict=None,
+                 limit_type:str=None,
+                 ) -> None:
+        super().__init__(url, cookies, headers, params, proxies, limit_type)
+        self.sessions = sessions
+
+    async def get(self) -> Response:
+        bucket = self.get_bucket()
+        if bucket:
+            await bucket.async_acquire()
+        session = self.sessions.get_session(self.url)
+        start = time.perf_counter()
+        try:
+            response = await session.get(self.url,
+                                         params=self.params,
+                                         cookies=self.cookies,
+                                         headers=self.headers,
+                                         proxies=self.proxies,
+                                         timeout=60,
+                                         impersonate=cffi_requests.BrowserType.chrome
+                                         )
+        except Exception:
+            limit_feedback(bucket, None)
+            record_request(self.limit_type, start, None)
+            raise
+        limit_feedback(bucket, response.status_code)
+        record_request(self.limit_type, start, response.status_code, len(response.content))
+        if response.status_code == 200:
+            return response
+        raise RequestError(f'请求失败 [url]:{self.url}, [status_code]:{response.status_code}',
+                           response.status_code)
+
+
+class AsyncHtmlTSLCrawler(AsyncTSLCrawler):
+    async def get(self, save_file:str=None) -> bytes:
+        response = await super().get()
+        if save_file:
+            with open(save_file, 'wb') as f:
+                f.write(response.content)
+        return response.content
+
+
+class AsyncImgTSLCrawler(AsyncTSLCrawler):
+
+    async def get(self) -> bytes:
+        response = await super().get()
+        if response and (r'image/' in response.headers.get('Content-Type', '')):
+            return response.content
         else:
             raise TypeError(f'响应数据类型不是图. Content-Type:{response.headers.get("Content-Type", "")}')
\ No newline at end of file
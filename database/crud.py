@@ -1,26 +1,31 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, bindparam
+from sqlalchemy.dialects.sqlite import insert
 from threading import Lock
 import functools
+import time
 
+from metrics import DB_LOCK_WAIT_SECONDS
 from database import models
 from database.database import engine
 
 models.Base.metadata.create_all(bind=engine)  # 创建表
-db_lock = Lock()
+models.create_indexes(engine)  # 旧数据库补充索引
+db_lock = Lock()  # 写操作锁，SQLite同时只能有一个写入，读操作使用各自线程的会话不需要加锁
 
 
 def lock(lock: Lock):
     def wrapper1(func):
         @functools.wraps(func)
         def wrapper2(*args, **kwargs):
+            start = time.perf_counter()
             with lock:
+                DB_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
                 return func(*args, **kwargs)
         return wrapper2
     return wrapper1
 
 
-@lock(db_lock)
 def refresh(db: Session, obj):
     db.refresh(obj)
 
@@ -38,17 +43,14 @@ def add_comic(db: Session, comic: models.Comic, commit=True) -> models.Comic:
     return comic
 
 
-@lock(db_lock)
 def query_comic(db: Session, comicid: int) -> models.Comic | None:
     return db.query(models.Comic).filter(models.Comic.comicid == comicid).first()
 
 
-@lock(db_lock)
 def query_comics(db: Session) -> list[models.Comic] | None:
     return db.query(models.Comic).all()
 
 
-@lock(db_lock)
 def query_static(db: Session, static: int) -> list[models.Comic] | None:
     return db.query(models.Comic).filter(models.Comic.static == static).all()
 
@@ -58,7 +60,6 @@ def del_comic(db: Session, comic: models.Comic):
     db.delete(comic)
     db.commit()
 
-@lock(db_lock)
 def queue_comic_arr(db: Session, comic:models.Comic, *args) -> tuple:
     return db.query(*args).filter(models.Comic.id == comic.id).first()
 
@@ -95,11 +96,9 @@ def modify_comic(db: Session, comic: models.Comic, **kwargs) -> models.Comic:
     db.refresh(comic)
     return comic
 
-@lock(db_lock)
 def query_comic_chapters(db: Session, comic:models.Comic, *args) -> tuple:
     return db.query(*args).filter(models.Comic.id == comic.id).join(models.Comic, models.Comic.id == models.Chapter.main_comic).all()
 
-@lock(db_lock)
 def query_comic_arr(db: Session, comic:models.Comic, *args) -> tuple:
     return db.query(*args).filter(models.Comic.id == comic.id).first()
 
@@ -111,7 +110,6 @@ Tag
 '''
 
 
-@lock(db_lock)
 def query_tag(db: Session, tag: str) -> models.Tag:
     return db.query(models.Tag).filter(models.Tag.text == tag).first()
 
@@ -155,36 +153,29 @@ def modify_chapter(db: Session, chapter: models.Chapter, **kwargs) -> models.Cha
     return chapter
 
 
-@lock(db_lock)
 def query_chapters(db: Session) -> list[models.Chapter] | None:
     return db.query(models.Chapter).all()
 
 
-@lock(db_lock)
 def query_chapter(db: Session, comicid: int) -> models.Chapter | None:
     return db.query(models.Chapter).filter(models.Chapter.comicid == comicid).first()
 
 
-@lock(db_lock)
 def query_chapters_static(db: Session, static: int) -> list[models.Chapter] | None:
     return db.query(models.Chapter).filter(models.Chapter.static == static).all()
 
-@lock(db_lock)
 def query_chapter_arr(db: Session, chapter:models.Chapter, *args) -> tuple:
     return db.query(*args).filter(models.Chapter.id == chapter.id).first()
 
-@lock(db_lock)
 def query_chapter_imgs(db: Session, chapter:models.Chapter, *args) -> tuple:
     return db.query(*args).filter(models.Chapter.comicid == chapter.comicid).join(models.Chapter, models.Chapter.id == models.ComicImg.chapterid).all()
 
-@lock(db_lock)
 def query_chapter_comic(db: Session, chapter:models.Chapter, *args) -> tuple:
     return db.query(*args).filter(models.Chapter.comicid == chapter.comicid).join(models.Chapter, models.Chapter.main_comic == models.Comic.id).first()
 
 '''
 ComicImg
 '''
-@lock(db_lock)
 def query_comicimg(db: Session, comicid: int, page: int) -> models.ComicImg | None:
     chapter = db.query(models.Chapter).filter(
         models.Chapter.comicid == comicid).first()
@@ -199,7 +190,6 @@ def query_comicimg(db: Session, comicid: int, page: int) -> models.ComicImg | No
     ).first()
 
 
-@lock(db_lock)
 def query_comicimg_by_chapterid(db: Session, chapterid: int, page: int) -> models.ComicImg | None:
     return db.query(models.ComicImg) \
         .filter(
@@ -209,7 +199,6 @@ def query_comicimg_by_chapterid(db: Session, chapterid: int, page: int) -> model
             )
     ).first()
 
-@lock(db_lock)
 def query_comicimg_by_url(db: Session, comicid: int, url: str) -> models.ComicImg | None:
     chapter = db.query(models.Chapter).filter(
         models.Chapter.comicid == comicid).first()
@@ -231,12 +220,13 @@ def add_comicimg(db: Session, comicimg: models.ComicImg) -> models.ComicImg:
     db.refresh(comicimg)
     return comicimg
 
-@lock(db_lock)
 def query_comicimg_arr(db: Session, img:models.ComicImg, *args) -> tuple:
     return db.query(*args).filter(models.ComicImg.id == img.id).first()
 
+@lock(db_lock)
 def home_data_to_db(db: Session, data: dict) -> bool:
     """漫画详情页数据入数据库
+    漫画、标签、章节在一个事务中写入，只提交一次
 
     Args:
         db (Session): 数据库
@@ -251,67 +241,243 @@ def home_data_to_db(db: Session, data: dict) -> bool:
     if not comicid:
         return False
 
-    comic = query_comic(db, comicid)
+    comic = db.query(models.Comic).filter(models.Comic.comicid == comicid).first()
     if not comic:
-        comic = add_comic(db, models.Comic(comicid=comicid))
-
-    author = data.get('author', None)
-    if author:
-        author = ' '.join(author)
+        comic = models.Comic(comicid=comicid)
+        db.add(comic)
     else:
-        author = []
-    comic = modify_comic(
-        db,
-        comic,
-        url=data.get('url', ''),
-        title=data.get('title', ''),
-        description=data.get('description', ''),
-        page=data.get('page', 0),
-        author=author,
-        tags=data.get('tags', [])
-    )
-
-    # 处理每一章
+        db.refresh(comic)
+
+    comic.url = data.get('url', '')
+    comic.title = data.get('title', '')
+    comic.description = data.get('description', '')
+    comic.page = data.get('page', 0)
+
+    # 标签，一次查询出已存在的标签
+    tags = set(data.get('tags', None) or [])
+    if tags:
+        exist_tags = {tag.text: tag for tag in db.query(models.Tag).filter(models.Tag.text.in_(tags)).all()}
+        for tag in tags:
+            res_tag = exist_tags.get(tag, None)
+            if not res_tag:
+                res_tag = models.Tag(text=tag)
+                db.add(res_tag)
+            if res_tag not in comic.tags:
+                comic.tags.append(res_tag)
+
+    # 处理每一章，一次查询出已存在的章节
     nexts = data.get('next', None)
     if nexts:
-        for next in nexts:
-            next_comic = query_chapter(db, int(next))
-            if not next_comic:
-                next_comic = add_chapter(db, models.Chapter(comicid=int(next)))
-            next_comic = modify_chapter(
-                db, next_comic, chapter_num=nexts.index(next) + 1)
-
-            comic = modify_comic(db, comic, chapters=next_comic)
+        nexts = [int(next) for next in nexts]
+        exist_chapters = {chapter.comicid: chapter for chapter in db.query(
+            models.Chapter).filter(models.Chapter.comicid.in_(nexts)).all()}
+        for index, next in enumerate(nexts):
+            chapter = exist_chapters.get(next, None)
+            if not chapter:
+                chapter = models.Chapter(comicid=next)
+                db.add(chapter)
+                exist_chapters[next] = chapter
+            chapter.chapter_num = index + 1
+            if chapter not in comic.chapters:
+                comic.chapters.append(chapter)
 
+    db.commit()
     return True
 
 
 @lock(db_lock)
-def search_data_to_db(db: Session, data: list) -> None:
-    """搜索页面解析的数据入数据库
+def chapter_data_to_db(db: Session, comicid: int, title: str, page: int, imgs: list[tuple]) -> models.Chapter:
+    """章节页面数据入数据库
+    章节和所有图片在一个事务中写入，只提交一次
+
+    Args:
+        db (Session): 数据库
+        comicid (int): 章节id
+        title (str): 章节标题
+        page (int): 章节页数
+        imgs (list[tuple]): 图片数据，格式[(url, page),...]
+
+    Returns:
+        models.Chapter: 入库后的章节
+    """
+    chapter = db.query(models.Chapter).filter(models.Chapter.comicid == comicid).first()
+    if not chapter:
+        chapter = models.Chapter(comicid=comicid)
+        db.add(chapter)
+        db.flush()  # 获取chapter.id
+    chapter.page = page
+    chapter.title = title
+
+    exist_pages = {i[0] for i in db.query(models.ComicImg.page).filter(
+        models.ComicImg.chapterid == chapter.id).all()}
+    new_imgs = []
+    for url, img_page in imgs:
+        if img_page in exist_pages:
+            continue
+        exist_pages.add(img_page)
+        new_imgs.append(models.ComicImg(chapterid=chapter.id, url=url, page=img_page))
+    if new_imgs:
+        db.add_all(new_imgs)
+
+    db.commit()
+    return chapter
+
+
+@lock(db_lock)
+def search_data_to_db(db: Session, data: list, key: str = None, pages: list[tuple] = None) -> None:
+    """搜索页面解析的数据入数据库，多页数据一次提交
 
     Args:
         db (Session): 数据库
         data (list): 搜索数据，格式[[id, url],[id, url],...,[id, url]]
+        key (str, optional): 搜索内容，和pages一起记录已完成的搜索页. Defaults to None.
+        pages (list[tuple], optional): 已完成的搜索页，格式[(页数, 总页数),...]. Defaults to None.
     """
-    comics = []
+    urls = {}
     for item in data:
-        comic = db.query(models.Comic).filter(
-            models.Comic.comicid == int(item[0])).first()
-        if not comic:
-            comic = models.Comic(comicid=int(item[0]))
-
-        if not comic.url:
-            comic.url = item[1]
-            comics.append(comic)
+        urls.setdefault(int(item[0]), item[1])
+
+    comics = []
+    if urls:
+        exist = {comic.comicid: comic for comic in db.query(models.Comic).filter(
+            models.Comic.comicid.in_(urls.keys()))}
+        for comicid, url in urls.items():
+            comic = exist.get(comicid, None)
+            if not comic:
+                comic = models.Comic(comicid=comicid)
+            if not comic.url:
+                comic.url = url
+                comics.append(comic)
     if comics:
         db.add_all(comics)
-        db.commit()
+
+    if key is not None and pages:
+        stmt = insert(models.SearchPage.__table__).on_conflict_do_nothing(
+            index_elements=['key', 'page'])
+        db.execute(stmt, [{'key': key, 'page': page, 'total_page': total_page}
+                          for page, total_page in pages])
+    db.commit()
+
+
+def query_search_pages(db: Session, key: str) -> dict[int, int]:
+    """查询已完成的搜索页
+
+    Returns:
+        dict[int, int]: {页数: 总页数}
+    """
+    return dict(db.query(models.SearchPage.page, models.SearchPage.total_page)
+                .filter(models.SearchPage.key == key).all())
+
+
+@lock(db_lock)
+def del_search_pages(db: Session, key: str) -> None:
+    db.query(models.SearchPage).filter(models.SearchPage.key == key).delete()
+    db.commit()
+
+def query_chapter_img_pages(db: Session) -> dict[int, tuple[int, set[int]]]:
+    """一次查询所有章节的页数和图片页数
+
+    Returns:
+        dict[int, tuple[int, set[int]]]: {章节comicid: (Chapter.page, {ComicImg.page,...})}
+    """
+    ret = {}
+    rows = db.query(models.Chapter.comicid, models.Chapter.page, models.ComicImg.page) \
+        .outerjoin(models.ComicImg, models.ComicImg.chapterid == models.Chapter.id).all()
+    for comicid, chapter_page, img_page in rows:
+        if comicid not in ret:
+            ret[comicid] = (chapter_page, set())
+        if img_page is not None:
+            ret[comicid][1].add(img_page)
+    return ret
+
+
+@lock(db_lock)
+def reset_chapters_static(db: Session, comicids: list[int]) -> None:
+    """章节设置为下载中，所属漫画已完成的也设置为下载中，其他状态的漫画不修改
+    """
+    # 分批查询，避免超过SQLite的参数数量限制
+    for i in range(0, len(comicids), 500):
+        batch = comicids[i:i + 500]
+        db.query(models.Chapter).filter(models.Chapter.comicid.in_(batch)) \
+            .update({models.Chapter.static: 0}, synchronize_session=False)
+        main_comics = db.query(models.Chapter.main_comic).filter(models.Chapter.comicid.in_(batch))
+        db.query(models.Comic).filter(models.Comic.id.in_(main_comics.scalar_subquery()), models.Comic.static == 1) \
+            .update({models.Comic.static: 0}, synchronize_session=False)
+    db.commit()
+
 
 '''
-other
+Task
 '''
+def query_tasks(db: Session, statics: list[int]) -> list[tuple]:
+    return db.query(models.Task.type, models.Task.comicid, models.Task.page, models.Task.attempts) \
+        .filter(models.Task.static.in_(statics)).all()
+
+
+def query_task_comicids(db: Session, statics: list[int]) -> set[int]:
+    """任务所属漫画的comicid，主页任务直接是漫画，章节和图片任务通过章节查找漫画
+
+    Returns:
+        set[int]: {漫画comicid,...}
+    """
+    comics = db.query(models.Task.comicid) \
+        .filter(models.Task.type == 0, models.Task.static.in_(statics)).all()
+    chapters = db.query(models.Comic.comicid).distinct() \
+        .join(models.Chapter, models.Chapter.main_comic == models.Comic.id) \
+        .join(models.Task, models.Task.comicid == models.Chapter.comicid) \
+        .filter(models.Task.type.in_((1, 2)), models.Task.static.in_(statics)).all()
+    return {row[0] for row in comics} | {row[0] for row in chapters}
+
+
+@lock(db_lock)
+def del_old_tasks(db: Session, static: int, days: int) -> int:
+    """删除超过days天没有更新的任务
+
+    Returns:
+        int: 删除的任务数
+    """
+    count = db.query(models.Task) \
+        .filter(models.Task.static == static,
+                models.Task.update_time < func.datetime('now', f'-{int(days)} days')) \
+        .delete(synchronize_session=False)
+    db.commit()
+    return count
+
+
 @lock(db_lock)
+def save_tasks(db: Session, tasks: list[dict], del_tasks: list[dict]) -> None:
+    """批量保存任务，一次提交
+
+    Args:
+        db (Session): 数据库
+        tasks (list[dict]): 新增或修改的任务，格式{'type', 'comicid', 'page', 'static', 'attempts'}
+        del_tasks (list[dict]): 删除的任务，格式{'type', 'comicid', 'page'}
+    """
+    table = models.Task.__table__
+    if tasks:
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['type', 'comicid', 'page'],
+            set_={'static': stmt.excluded.static,
+                  'attempts': stmt.excluded.attempts,
+                  'update_time': func.now()}
+        )
+        db.execute(stmt, tasks)
+    if del_tasks:
+        stmt = table.delete().where(
+            and_(
+                table.c.type == bindparam('b_type'),
+                table.c.comicid == bindparam('b_comicid'),
+                table.c.page == bindparam('b_page')
+            )
+        )
+        db.execute(stmt, [{'b_type': i['type'], 'b_comicid': i['comicid'], 'b_page': i['page']}
+                          for i in del_tasks])
+    db.commit()
+
+'''
+other
+'''
 def count_percent(db: Session, main_key, tag_key, tag_val) -> float:
     count = db.query(func.count(main_key)).filter(tag_key == tag_val).scalar() 
     total = db.query(func.count(main_key)).scalar()
@@ -1,14 +1,38 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 DB_FILE = r'db/jmcomic.db'
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_FILE}"
 
+# 连接参数
+# WAL模式下读写互不阻塞，synchronous=NORMAL在WAL模式下只在检查点同步磁盘
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # 负数单位是KB，64MB
+    'mmap_size': 268435456,  # 256MB
+    'temp_store': 'MEMORY',
+    'busy_timeout': 10000,  # 毫秒
+}
+
+# pool_size只是保留的空闲连接数，max_overflow=-1不限制连接数，线程再多也不会等待连接
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+    pool_size=20, max_overflow=-1
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for key, value in PRAGMAS.items():
+        cursor.execute(f'PRAGMA {key}={value}')
+    cursor.close()
+
+
+# 对象在提交后不过期，不同线程的会话之间传递对象时不会触发跨线程的重新加载
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 Base = declarative_base()
 
@@ -21,4 +45,6 @@ def get_db():
         db.close()
 
 
-db = next(get_db())
\ No newline at end of file
+# 每个线程使用独立的会话，用法和Session相同
+# 只读查询不会提交，会话会一直占用连接，线程中的任务完成后要调用db.remove()释放
+db = scoped_session(SessionLocal)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey, UniqueConstraint, Index, inspect, text
 from sqlalchemy.orm import relationship
 
 from database.database import Base
@@ -6,6 +6,7 @@ from database.database import Base
 
 class Comic(Base):
     __tablename__ = 'comic'
+    __table_args__ = (Index('ix_comic_static', 'static'),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)  # 主键自动增长
     comicid = Column(Integer, unique=True, default=0)  # 禁漫id
@@ -25,6 +26,10 @@ class Comic(Base):
 
 class Chapter(Base):
     __tablename__ = 'chapter'
+    __table_args__ = (
+        Index('ix_chapter_static', 'static'),
+        Index('ix_chapter_main_comic_static', 'main_comic', 'static'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)  # 主键自动增长
     main_comic = Column(Integer, ForeignKey(
@@ -46,6 +51,11 @@ class Chapter(Base):
 
 class ComicImg(Base):
     __tablename__ = 'comicimg'
+    __table_args__ = (
+        # 覆盖按章节查询所有图片和按章节、页数查询图片
+        Index('ix_comicimg_chapterid_page_url', 'chapterid', 'page', 'url'),
+        Index('ix_comicimg_url', 'url'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)  # 主键自动增长
     chapterid = Column(Integer, ForeignKey('chapter.id'))
@@ -75,7 +85,71 @@ class Tag(Base):
 
 class Comic_Tag(Base):
     __tablename__ = 'comic_tag'
+    __table_args__ = (
+        Index('ix_comic_tag_comicid_tagid', 'comicid', 'tagid'),
+        Index('ix_comic_tag_tagid', 'tagid'),
+    )
 
     id = Column(Integer, primary_key=True)
     comicid = Column(Integer, ForeignKey('comic.id'))
-    tagid = Column(Integer, ForeignKey('tag.id'))
\ No newline at end of file
+    tagid = Column(Integer, ForeignKey('tag.id'))
+
+
+class Task(Base):
+    """下载任务队列持久化，重启后直接加载未完成的任务
+    """
+    __tablename__ = 'task'
+    __table_args__ = (
+        UniqueConstraint('type', 'comicid', 'page'),
+        Index('ix_task_static', 'static'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)  # 主键自动增长
+    type = Column(Integer, default=0)  # 任务类型，0主页，1章节，2图片
+    comicid = Column(Integer, default=0)  # 禁漫id
+    page = Column(Integer, default=0)  # 图片页数，只有图片任务使用
+    static = Column(Integer, default=0)  # 状态，0等待，1下载中，2失败
+    attempts = Column(Integer, default=0)  # 失败次数
+    update_time = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f'<Task({self.id}, {self.type}, {self.comicid}, {self.page}, {self.static}, {self.attempts})>'
+
+
+class SearchPage(Base):
+    """已完成的搜索页，搜索中断后继续时跳过这些页，搜索完成后删除
+    """
+    __tablename__ = 'search_page'
+    __table_args__ = (UniqueConstraint('key', 'page'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)  # 主键自动增长
+    key = Column(String, default='')  # 搜索内容
+    page = Column(Integer, default=0)  # 搜索结果的页数
+    total_page = Column(Integer, default=0)  # 该页显示的总页数
+
+    def __repr__(self):
+        return f'<SearchPage({self.id}, {self.key}, {self.page}, {self.total_page})>'
+
+
+def create_indexes(bind) -> list[str]:
+    """给已存在的数据库补充缺少的索引
+
+    create_all只会创建不存在的表，旧数据库的表不会添加新索引
+
+    Returns:
+        list[str]: 新创建的索引名
+    """
+    inspector = inspect(bind)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        exist = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in exist:
+                index.create(bind=bind)
+                created.append(index.name)
+    if created:
+        # 更新统计信息，让查询计划使用新索引
+        with bind.connect() as conn:
+            conn.execute(text('ANALYZE'))
+            conn.commit()
+    return created
@@ -1,6 +1,10 @@
 from copy import deepcopy
 import os
 import json
+import atexit
+from threading import Lock, RLock, Timer
+
+from jmlogger import logger
 
 # class MyConfig:
 #     @staticmethod
@@ -24,6 +28,7 @@ os.makedirs(json_dir, exist_ok=True)
 JSON_PATH = os.path.join(json_dir, 'config.json')
 DEFUALT_DATA = {
     "progress_log": 60,
+    "metrics_port": 9108,
     "download_content":{
         "comic":True,
         "chapter":True,
@@ -38,6 +43,8 @@ DEFUALT_DATA = {
         "key": "",
         "max_page": 0
     },
+    "search_thread_max": 5,
+    "search_batch_size": 20,
     "filter_tag": [
         "yaoi",
         "cosplay",
@@ -63,7 +70,13 @@ DEFUALT_DATA = {
         "动图"
     ],
     "save_dir": "",
+    "library_dirs": [],
+    "scan_thread_max": 16,
     "out_zip": "",
+    "zip_mode": "single",
+    "zip_compress": False,
+    "out_zip_dir": "",
+    "zip_thread_max": 0,
     "username": "",
     "password": "",
     "cookie": {
@@ -71,44 +84,162 @@ DEFUALT_DATA = {
         "_gali": "wrapper"
     },
     "cookie_update": "",
-    "proxies": {}
+    "proxies": {},
+    "html_dump": False,
+    "session_pool_size": 10,
+    "thread_max": 5,
+    "max_running": 10,
+    "failed_task_days": 7,
+    "task_max_attempts": 5,
+    "cpu_max": 0,
+    "cpu_queue_size": 0,
+    "download_mode": "thread",
+    "async_limit": {
+        "comic": 5,
+        "chapter": 10,
+        "img": 100
+    },
+    "rate_limit": {
+        "search": 2,
+        "photo": 5,
+        "album": 5,
+        "img": 20
+    }
 }
 
 
 class MyConfig(dict):
-    def __init__(self, config_path: str) -> None:
-        self.fio = None
+    """配置，读取直接访问内存，线程安全
+
+    修改后不会马上写文件，等待delay秒合并多次修改再写入，
+    写入时先写临时文件再替换，中途退出不会损坏配置文件。
+    可以用subscribe监听配置修改，reload会读取在外部修改的配置文件并通知监听者。
+    """
+
+    def __init__(self, config_path: str, delay: float = 1) -> None:
+        """
+        Args:
+            config_path (str): 配置文件
+            delay (float, optional): 修改后等待多少秒写入文件. Defaults to 1.
+        """
+        self.config_path = config_path
+        self.delay = delay
+        self._lock = RLock()
+        self._save_lock = Lock()  # 保证同时只有一个线程写文件
+        self._timer: Timer | None = None
+        self._dirty_keys = set()  # 还没写入文件的修改
+        self._version = 0  # 每次修改加1，用于判断写入期间是否有新的修改
+        self._listeners: dict[object, list] = {}
+        self._mtime = None
 
         # 文件不存在则创建文件
         if not os.path.exists(config_path):
             with open(config_path, 'w', encoding='utf-8'):
                 pass
-        self.fio = open(config_path, 'r+', encoding='utf-8') # 不能用a+，a+只能追加内容，不能在指定位置修改内容
-        data = self.fio.read()
+        self.update(self._read())
+        atexit.register(self.flush)
+
+    def _read(self) -> dict:
+        with open(self.config_path, 'r', encoding='utf-8') as f:
+            self._mtime = os.fstat(f.fileno()).st_mtime_ns
+            data = f.read()
         if not data:  # 文件内容为空时，json会报错
             data = "{}"
-        json_data = json.loads(data)
-        self.update(json_data)
-
-    def save(self):
-        self.fio.seek(0)
-        json.dump(self, self.fio ,ensure_ascii=False, indent=4)
-        self.fio.flush()  # 将缓存刷新到磁盘
-        self.fio.truncate()  # 清空指针位置后面的内容，会直接写磁盘
+        return json.loads(data)
+
+    def save(self) -> bool:
+        """马上写入文件，失败时保留未写入的修改，delay秒后重试
+
+        Returns:
+            bool: 是否写入成功
+        """
+        with self._save_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                version = self._version
+                data = json.dumps(self, ensure_ascii=False, indent=4)
+            tmp_path = f'{self.config_path}.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                # 文件被其他程序打开时，Windows上替换会失败
+                os.replace(tmp_path, self.config_path)
+                self._mtime = os.stat(self.config_path).st_mtime_ns
+            except OSError as e:
+                logger.error(f'写入配置文件失败，{self.delay}秒后重试. {e}')
+                with self._lock:
+                    self._schedule_save()
+                return False
+            with self._lock:
+                # 写入期间有新的修改时保留，等待下次写入
+                if version == self._version:
+                    self._dirty_keys.clear()
+            return True
+
+    def flush(self):
+        """有未写入的修改时写入文件
+        """
+        if self._dirty_keys:
+            self.save()
+
+    def _schedule_save(self):
+        if self._timer is None:
+            self._timer = Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def subscribe(self, key, callback):
+        """监听配置修改
+
+        Args:
+            key (object): 配置名
+            callback (function): 修改后调用，参数是(配置名, 新的值)
+        """
+        with self._lock:
+            self._listeners.setdefault(key, []).append(callback)
+
+    def _notify(self, key, value):
+        for callback in self._listeners.get(key, []):
+            callback(key, value)
+
+    def reload(self) -> list:
+        """配置文件在外部被修改时重新读取，没有写入的修改优先
+
+        Returns:
+            list: 修改了的配置名
+        """
+        try:
+            if os.stat(self.config_path).st_mtime_ns == self._mtime:
+                return []
+            data = self._read()
+        except (OSError, ValueError):
+            # 文件正在被编辑，下次再读取
+            return []
+        changed = []
+        with self._lock:
+            for key, value in data.items():
+                if key not in self._dirty_keys and super().get(key, None) != value:
+                    super().__setitem__(key, value)
+                    changed.append(key)
+        for key in changed:
+            self._notify(key, data[key])
+        return changed
 
     def close(self):
-        if self.fio:
-            self.fio.close()
-
-    def __del__(self):
-        self.close()
+        self.flush()
 
     def __getitem__(self, key):
         return super().__getitem__(key)
 
     def __setitem__(self, key: object, value: object) -> None:
-        super().__setitem__(key, value)
-        self.save()
+        with self._lock:
+            super().__setitem__(key, value)
+            self._dirty_keys.add(key)
+            self._version += 1
+            self._schedule_save()
+        self._notify(key, value)
 
     def get(self, key, default=None):
         return super().get(key, default)
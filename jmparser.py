@@ -0,0 +1,257 @@
+"""
+禁漫网页解析
+
+XPath和正则表达式在导入时编译，解析时直接使用，
+每个网页只解析成一次lxml元素
+"""
+import re
+
+from lxml import etree
+
+
+# 漫画页面
+_COMIC_URLS = etree.XPath('//div[@class="center scramble-page"]/img/@data-original')
+_COMIC_TITLE = etree.XPath(
+    '//div[@class="container"]/div[@class="row"]/div/div[@class="panel panel-default"]/div[@class="panel-heading"]/div[@class="pull-left"]/text()')
+_COMIC_NEXT = etree.XPath('//i[@class="fas fa-angle-double-right"]/../@href')
+_COMIC_PREVIOUS = etree.XPath('//i[@class="fa fa-angle-double-left"]/../@href')
+_COMIC_PAGINATION = etree.XPath('//div[@class="hidden-xs"]/ul[@class="pagination"]/li')
+_COMIC_LAST_PAGE = etree.XPath('span/text()')
+_COMIC_MAX_PAGE = etree.XPath('a/text()')
+_COMIC_HOME_URL_1 = etree.XPath('//div[@class="menu-bolock hidden-xs hidden-sm"]/ul[2]/li[6]/a/@href')
+_COMIC_HOME_URL_2 = etree.XPath('//div[@class="menu-bolock hidden-xs hidden-sm"]/ul[2]/li[5]/a/@href')
+
+# 主页
+_HOME_URL = etree.XPath('//*[@property="og:url"]/@content')
+_HOME_TITLE = etree.XPath('//div[@class="panel-heading"]/div[@itemprop="name"]/h1/text()')
+_HOME_COMICID = etree.XPath('//div[@class="panel-body"]/div/div[2]/div[1]/div[1]/text()')
+_HOME_TAGS = etree.XPath(
+    '//div[@class="panel-body"]/div/div[2]/div[1]/div[4]/span[@data-type="tags"]/a/text()')
+_HOME_AUTHOR = etree.XPath('//div[@class="panel-body"]/div/div[2]/div[1]/div[5]/span/a/text()')
+_HOME_DESCRIPTION = etree.XPath('//div[@class="panel-body"]/div/div[2]/div[1]/div[8]/text()')
+_HOME_PAGE = etree.XPath('//div[@class="panel-body"]/div/div[2]/div[1]/div[9]/text()')
+_HOME_NEXT = etree.XPath('//div[@class="panel-body"]/div/div[2]/div[3]/div//ul/a/@data-album')
+
+_COMICID_RE = re.compile(r'JM(\d+)')
+_DESCRIPTION_RE = re.compile(r'敘述：(.*)', re.DOTALL)
+_PAGE_RE = re.compile(r'頁數：(\d+)')
+
+# 搜索页面
+_SEARCH_ITEMS_1 = etree.XPath('//div[@class="row m-0"]/div')
+_SEARCH_ITEMS_2 = etree.XPath('//div[@class="container"]/div[3]/div/div/div')
+_SEARCH_ITEM_URL = etree.XPath('div/a/@href')
+_SEARCH_ITEM_TAGS = etree.XPath('div/div[2]//a/text()')
+# 页数栏会根据不同页数发生变化，这几个位置都可能是总页数
+_SEARCH_PAGE_LI8 = etree.XPath('//ul[@class="pagination"]/li[8]/a/text()')
+_SEARCH_PAGE_LI5 = etree.XPath('//ul[@class="pagination"]/li[5]/a/text()')
+_SEARCH_PAGE_LI9 = etree.XPath('//ul[@class="pagination"]/li[9]/a/text()')
+_SEARCH_PAGE_SPAN8 = etree.XPath('//ul[@class="pagination"]/li[8]/span/text()')
+
+
+def parse_html(html: bytes):
+    """网页数据转成lxml元素，网站使用utf-8编码
+    """
+    return etree.HTML(html.decode('utf-8', errors='replace'))
+
+
+def parse_comic_page(html: bytes, root_url: str) -> dict:
+    """解析漫画页面数据
+
+    Args:
+        html (bytes): 网页数据
+        root_url (str): 网站根链接，用于拼接主页链接
+
+    Returns:
+        dict: 解析数据
+    """
+    root_element = parse_html(html)
+    ret_data = {}
+
+    # 所有图片url
+    ret_data['urls'] = _COMIC_URLS(root_element)
+
+    # 漫画标题
+    title = _COMIC_TITLE(root_element)
+    if title:
+        ret_data['title'] = title[0].replace('\n', '').strip()
+
+    # 下一话id
+    next_comic = _COMIC_NEXT(root_element)
+    if next_comic:
+        ret_data['next_comic'] = next_comic[0].split('/')[-1].split('?')[0]
+
+    # 上一话
+    previous_comic = _COMIC_PREVIOUS(root_element)
+    if previous_comic:
+        ret_data['previous_comic'] = previous_comic[0].split('/')[-1].split('?')[0]
+
+    # 获取最大页数
+    # 如果当前页面是最后一页，统计该漫画有多少页
+    curr_page = _COMIC_PAGINATION(root_element)
+    if curr_page:
+        # 当前页面如果是最后一页，会少一个跳到尾部的li标签，所以直接判断最后一个
+        if curr_page[-1].attrib.get('class', None):
+            max_page = _COMIC_LAST_PAGE(curr_page[-1])
+            ret_data['max_page'] = int(max_page[0])
+            ret_data['curr_page'] = len(
+                ret_data['urls']) + (ret_data['max_page'] - 1) * 300
+        else:
+            # 不在最后一页，尾部会多个跳到尾部的li标签，所以倒数第二个才是最大页数
+            max_page = _COMIC_MAX_PAGE(curr_page[-2])
+            ret_data['max_page'] = int(max_page[0])
+            ret_data['curr_page'] = 0
+    else:  # 没有该标签表示没有分页
+        ret_data['curr_page'] = len(ret_data['urls'])
+        ret_data['max_page'] = 1
+
+    # 获取介绍页面链接
+    ret_data['home_url'] = None
+    home_url = _COMIC_HOME_URL_1(root_element)
+    if home_url and home_url[0] != 'javascript:void(0)':
+        ret_data['home_url'] = ''.join((root_url, home_url[0]))
+
+    if not ret_data['home_url']:
+        home_url = _COMIC_HOME_URL_2(root_element)
+        if home_url:
+            ret_data['home_url'] = ''.join((root_url, home_url[0]))
+
+    return ret_data
+
+
+def parse_home_page(html: bytes) -> dict:
+    """解析主页数据
+
+    Args:
+        html (bytes): 网页数据
+
+    Returns:
+        dict: 解析结果
+    """
+    root_element = parse_html(html)
+    res_list = {}
+
+    res_list['url'] = ''
+    url = _HOME_URL(root_element)
+    if url:
+        res_list['url'] = url[0]
+
+    res_list['title'] = ''
+    title = _HOME_TITLE(root_element)
+    if title:
+        res_list['title'] = title[0]
+
+    res_list['comicid'] = None
+    comicid = _HOME_COMICID(root_element)
+    if comicid:
+        res = _COMICID_RE.findall(comicid[0])
+        if res:
+            res_list['comicid'] = int(res[0])
+
+    res_list['tags'] = None
+    tags = _HOME_TAGS(root_element)
+    if tags:
+        res_list['tags'] = tags
+
+    res_list['author'] = None
+    author = _HOME_AUTHOR(root_element)
+    if author:
+        res_list['author'] = author
+
+    res_list['description'] = ''
+    description = _HOME_DESCRIPTION(root_element)
+    if description:
+        res = _DESCRIPTION_RE.findall(description[0])
+        if res:
+            res_list['description'] = res[0]
+
+    res_list['page'] = 0
+    page = _HOME_PAGE(root_element)
+    if page:
+        res = _PAGE_RE.findall(page[0])
+        if res:
+            res_list['page'] = int(res[0])
+
+    res_list['next'] = None
+    next = _HOME_NEXT(root_element)
+    if next:
+        res_list['next'] = next
+
+    return res_list
+
+
+def _search_total_page(root_element) -> int:
+    page = 1
+    data = _SEARCH_PAGE_LI8(root_element)
+    if data and data[0] == '»':
+        data = _SEARCH_PAGE_LI5(root_element)
+    if data and data[0].isdecimal():
+        page = int(data[0])
+
+    for xpath in (_SEARCH_PAGE_LI9, _SEARCH_PAGE_SPAN8):
+        data = xpath(root_element)
+        if data and data[0].isdecimal():
+            if int(data[0]) > page:
+                page = int(data[0])
+    return page
+
+
+def parse_search_page(html: bytes, root_url: str, filter: list = None) -> dict:
+    """解析搜索页面，一次解析得到所有数据
+
+    Args:
+        html (bytes): 网页数据
+        root_url (str): 网站根链接，用于拼接漫画主页链接
+        filter (list, optional): 过滤tag，包含其中任意tag的漫画不放入comics. Defaults to None.
+
+    Returns:
+        dict: {'comics': [[漫画id, 漫画主页链接],...], 'tags': {漫画id: [tag,...]}, 'total_page': 总页数}
+    """
+    root_element = parse_html(html)
+    filter = set(filter) if filter else None
+    comics = []
+    tags = {}
+
+    items = _SEARCH_ITEMS_1(root_element)
+    items.extend(_SEARCH_ITEMS_2(root_element))
+    for i in items:
+        comic_url = _SEARCH_ITEM_URL(i)
+        if not comic_url:
+            continue
+        comicid = comic_url[0].split('/')[-2]
+        comic_tags = _SEARCH_ITEM_TAGS(i)
+        tags[comicid] = comic_tags
+
+        # 判断是否过滤
+        if filter and not filter.isdisjoint(comic_tags):
+            continue
+        comics.append([comicid, ''.join((root_url, comic_url[0]))])
+
+    return {'comics': comics, 'tags': tags, 'total_page': _search_total_page(root_element)}
+
+
+if __name__ == "__main__":
+    # 统计每个网页的解析耗时，网页用html_dump配置保存在tmp目录
+    # 文件名格式: {comicid}_page_{页数}.html, home_*.html, search_{页数}.html
+    import os
+    import sys
+    import time
+
+    fixture_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join('.', 'tmp')
+    root_url = 'https://18comic.org'
+    parsers = {'home_': parse_home_page,
+               'search_': lambda html: parse_search_page(html, root_url),
+               }
+    number = 50
+
+    for name in sorted(os.listdir(fixture_dir)):
+        if not name.endswith('.html'):
+            continue
+        func = next((v for k, v in parsers.items() if name.startswith(k)),
+                    lambda html: parse_comic_page(html, root_url))
+        with open(os.path.join(fixture_dir, name), 'rb') as f:
+            html = f.read()
+        start = time.perf_counter()
+        for _ in range(number):
+            func(html)
+        cost = (time.perf_counter() - start) / number * 1000
+        print(f'{name:<60} {len(html) / 1024:>8.1f}KB {cost:>8.2f}ms')
@@ -0,0 +1,188 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image, UnidentifiedImageError
+from sqlalchemy.orm import Session
+from tqdm import tqdm
+
+from jmtools import JMDirHandle, JMComicDirIndex
+from database.crud import query_chapter_img_pages, save_tasks, reset_chapters_static
+
+
+class JMLibraryScanner:
+    """检查漫画库的完整性
+
+    用线程池同时扫描多个漫画目录，网络磁盘上主要耗时在等待IO，
+    数据库中所有章节的图片页数只查询一次，再和目录中的文件对比，找出：
+    缺失的图片、下载失败时保存的1像素图片、没有JPEG结束标记的不完整图片
+    """
+
+    # 1像素图片的文件大小都小于这个值，超过的不需要打开检查
+    PLACEHOLDER_SIZE = 1024
+    # JPEG文件结束标记
+    JPEG_EOI = b'\xff\xd9'
+
+    def __init__(self, db: Session, dir_index: JMComicDirIndex, max_workers: int = 16,
+                 logger: logging.Logger | None = None) -> None:
+        """
+        Args:
+            db (Session): 数据库
+            dir_index (JMComicDirIndex): 漫画目录索引
+            max_workers (int, optional): 同时扫描的目录数. Defaults to 16.
+            logger (logging.Logger | None, optional): 日志. Defaults to None.
+        """
+        self.db = db
+        self.dir_index = dir_index
+        self.max_workers = max_workers
+        self.logger = logger
+
+    @classmethod
+    def check_img(cls, path: str, size: int) -> str | None:
+        """检查图片
+
+        Args:
+            path (str): 图片路径
+            size (int): 文件大小
+
+        Returns:
+            str | None: 'placeholder' 1像素图片，'truncated' 不完整，正常返回None
+        """
+        try:
+            if size < cls.PLACEHOLDER_SIZE:
+                with Image.open(path) as img:
+                    if img.size == (1, 1):
+                        return 'placeholder'
+            if size < len(cls.JPEG_EOI):
+                return 'truncated'
+            # 只读取文件末尾，不需要解码整张图片
+            with open(path, 'rb') as f:
+                f.seek(-len(cls.JPEG_EOI), os.SEEK_END)
+                # 有些图片结束标记后面会补0
+                if f.read() != cls.JPEG_EOI:
+                    f.seek(-min(size, 1024), os.SEEK_END)
+                    if cls.JPEG_EOI not in f.read():
+                        return 'truncated'
+        except (UnidentifiedImageError, OSError):
+            return 'truncated'
+        return None
+
+    @classmethod
+    def scan_dir(cls, comicid: str, dir: str) -> dict:
+        """扫描一个漫画目录
+
+        Returns:
+            dict: {'comicid': 章节id, 'dir': 目录, 'pages': {页数,...},
+                   'placeholder': [文件名,...], 'truncated': [文件名,...]}
+        """
+        result = {'comicid': int(comicid), 'dir': dir, 'pages': set(),
+                  'placeholder': [], 'truncated': []}
+        try:
+            with os.scandir(dir) as it:
+                entries = [entry for entry in it if entry.name.endswith('.jpg') and entry.is_file()]
+        except FileNotFoundError:
+            return result
+        for entry in entries:
+            page = JMDirHandle.jpg_to_page(entry.name)
+            if page is None:
+                continue
+            result['pages'].add(page)
+            error = cls.check_img(entry.path, entry.stat().st_size)
+            if error:
+                result[error].append(entry.name)
+        return result
+
+    def scan(self) -> dict:
+        """扫描整个漫画库
+
+        Returns:
+            dict: 检查报告 {'time': 时间, 'dirs': 目录数, 'chapters': {章节id: 问题}}，
+                  问题格式 {'dir': 目录, 'in_db': 数据库没有该章节时为False, 'missing': [页数,...], 'placeholder': [文件名,...],
+                  'truncated': [文件名,...], 'orphan': [数据库没有记录的有问题图片,...],
+                  'page_count': [Chapter.page, 数据库图片数, 文件数]}
+        """
+        self.dir_index.refresh()
+        comics = []
+        for comicid, dir in self.dir_index.items():
+            # 目录名格式是 "comicid-标题"，其他目录不是下载的漫画
+            if comicid.isdigit():
+                comics.append((comicid, dir))
+            elif self.logger:
+                self.logger.warning(f'跳过不是漫画的目录: {dir}')
+        # 所有章节的页数，只查询一次
+        expected = query_chapter_img_pages(self.db)
+
+        chapters = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = pool.map(lambda item: self.scan_dir(*item), comics)
+            for result in tqdm(results, total=len(comics)):
+                comicid = result['comicid']
+                chapter_page, img_pages = expected.get(comicid, (None, set()))
+                problem = {}
+                if chapter_page is None:
+                    # 数据库没有记录的章节，无法重新下载
+                    problem['in_db'] = False
+                missing = sorted(img_pages - result['pages'])
+                if missing:
+                    problem['missing'] = missing
+                orphan = []
+                for key in ('placeholder', 'truncated'):
+                    names = result[key]
+                    if chapter_page is not None:
+                        # 数据库没有这一页的图片无法重新下载，不删除，只报告
+                        orphan.extend(name for name in names if JMDirHandle.jpg_to_page(name) not in img_pages)
+                        names = [name for name in names if JMDirHandle.jpg_to_page(name) in img_pages]
+                    if names:
+                        problem[key] = sorted(names)
+                if orphan:
+                    problem['orphan'] = sorted(orphan)
+                if chapter_page is not None and not (chapter_page == len(img_pages) == len(result['pages'])):
+                    problem['page_count'] = [chapter_page, len(img_pages), len(result['pages'])]
+                if problem:
+                    problem['dir'] = result['dir']
+                    chapters[comicid] = problem
+
+        report = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                  'dirs': len(comics),
+                  'chapters': chapters}
+        if self.logger:
+            self.logger.info(f'检查漫画库完成，共{len(comics)}个目录，{len(chapters)}个目录有问题')
+        return report
+
+    def requeue(self, report: dict, delete: bool = True) -> int:
+        """把有问题的图片添加到下载任务，下次下载时重新下载
+
+        Args:
+            report (dict): scan返回的报告
+            delete (bool, optional): 删除1像素和不完整的图片，不删除下载时会被认为已完成. Defaults to True.
+
+        Returns:
+            int: 添加的图片任务数
+        """
+        tasks = []
+        for comicid, problem in report['chapters'].items():
+            if not problem.get('in_db', True):
+                continue
+            broken = problem.get('placeholder', []) + problem.get('truncated', [])
+            if delete:
+                for name in broken:
+                    path = os.path.join(problem['dir'], name)
+                    if os.path.exists(path):
+                        os.unlink(path)
+            pages = [JMDirHandle.jpg_to_page(name) for name in broken]
+            for page in problem.get('missing', []) + pages:
+                tasks.append({'type': 2, 'comicid': int(comicid), 'page': page,
+                              'static': 0, 'attempts': 0})
+        if tasks:
+            save_tasks(self.db, tasks, [])
+            reset_chapters_static(self.db, list({task['comicid'] for task in tasks}))
+        if self.logger:
+            self.logger.info(f'重新下载{len(tasks)}张图片')
+        return len(tasks)
+
+    @staticmethod
+    def save_report(report: dict, report_file: str):
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
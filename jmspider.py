@@ -1,25 +1,39 @@
 import os
+import json
 from datetime import date
 import time
+import asyncio
 import signal
-from threading import Lock
-import re
+from threading import Event, Lock
+from concurrent.futures import wait, FIRST_COMPLETED
+from zipfile import ZIP_DEFLATED, ZIP_STORED
 
-
-from lxml import etree
 from tqdm import tqdm
 
-from crawler import HtmlCrawler, HtmlTSLCrawler, ImgTSLCrawler
-from tools import retry, count_sleep, list_deduplication, clean_previous_line, traversal_dir, url_to_filename
+from crawler import (HtmlCrawler,
+                     HtmlTSLCrawler,
+                     ImgTSLCrawler,
+                     AsyncHtmlTSLCrawler,
+                     AsyncImgTSLCrawler,
+                     AsyncSessionPool,
+                     session_pool,
+                     rate_limiter,
+                     )
+from tools import retry, RetryPolicy, list_deduplication, clean_previous_line, url_to_filename, get_efficacious_filename
 from playwright_tool import login
-from jmtools import JMImgHandle, JMDirHandle
-from jmconfig import cfg
+from jmtools import JMImgHandle, JMDirHandle, JMFileIndex, JMComicDirIndex
+import jmparser
+from jmscanner import JMLibraryScanner
+from jmconfig import cfg, json_dir
 from jmlogger import logger
 from database.models import *
 from database.database import db
 from database.crud import *
-from threadingpool import MyTheadingPool, Future
+from threadingpool import MyTheadingPool, MyProcessPool, MyCoordinator, Future
+from asyncpool import MyAsyncPool
+from taskqueue import TaskQueue
 from MySigint import MySigint
+from metrics import registry, MetricsServer, IMG_SAVE_SECONDS, IMG_QUEUE_SECONDS
 
 
 TMP_DIR = os.path.join('.', 'tmp')
@@ -27,6 +41,22 @@ if not os.path.exists(TMP_DIR):
     os.makedirs(TMP_DIR)
 
 
+def html_dump_file(name: str) -> str | None:
+    """调试用，开启html_dump时返回保存网页的文件，否则返回None
+    """
+    if cfg.get('html_dump', False):
+        return os.path.join(TMP_DIR, get_efficacious_filename(name))
+    return None
+
+
+# 所有下载函数共享的重试策略，404等永久错误不重试
+retry_policy = RetryPolicy(times=3, base=1, max_sleep=30)
+registry.counter('jm_retries_total', '请求重试统计', ('event',),
+                 lambda: {(k,): v for k, v in retry_policy.stats().items() if k != 'budget'})
+registry.gauge('jm_retry_budget', '剩余的重试预算', (),
+               lambda: {(): retry_policy.stats()['budget']})
+
+
 class JMSpider:
     """禁漫爬虫
 
@@ -38,21 +68,93 @@ class JMSpider:
     # _headers = {'user-agent': 'PostmanRuntime/7.36.1'}
     _headers = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36'}
     _root_url = 'https://18comic.org/'
+    _home_headers = {
+        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,'
+        'application/signed-exchange;v=b3;q=0.7',
+        'accept-language': 'zh-CN,zh;q=0.9',
+        'sec-ch-ua': '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
+        'sec-ch-ua-mobile': '?0',
+        'sec-ch-ua-platform': '"Windows"',
+        'sec-fetch-dest': 'document',
+        'sec-fetch-mode': 'navigate',
+        'sec-fetch-site': 'none',
+        'sec-fetch-user': '?1',
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 '
+                  'Safari/537.36',
+        'authority': '18comic.vip',
+        'origin': 'https://18comic.vip',
+        'referer': 'https://18comic.vip'
+    }
 
     def __init__(self) -> None:
         self.cfg = cfg
         self.db = db
-        self.pool = MyTheadingPool(max=5)
-        self.queue_lock = Lock()  # 注意使用with只能操作self.task_queue，不能有其他代码，否则可能会死锁
-        self.task_queue = {'comic': {}, 'chapter': {}, 'img': {}}
+        self.pool = MyTheadingPool(max=self.cfg.get('thread_max', 5))
+        # 提交到线程池的任务数，包括运行中和等待中的
+        self.max_running = self.cfg.get('max_running', self.cfg.get('thread_max', 5) * 2)
+        # 图片处理进程池，0表示使用CPU核心数
+        self.cpu_pool = MyProcessPool(max=self.cfg.get('cpu_max', 0),
+                                      queue_size=self.cfg.get('cpu_queue_size', 0))
+        self.task_queue = TaskQueue(max_attempts=self.cfg.get('task_max_attempts', 5))
+        self.file_index = JMFileIndex()  # 已下载的图片文件
+        self.comic_dirs: dict[int, str] = {}  # 章节目录缓存 {comicid: 目录}
+        # 所有根目录下的漫画目录索引，打包和检查漫画时使用
+        self.dir_index = JMComicDirIndex(self.get_save_dirs(), os.path.join(json_dir, 'comic_dirs.json'))
+        # 章节未下载的图片 {章节comicid: {page,...}}，图片下载完成时更新，为空时章节完成
+        self.chapter_pending: dict[int, set[int]] = {}
+        # 启动时加载的任务所属的漫画，任务完成时会重新检查，启动时不需要检查
+        self.walked_comics: set[int] = set()
+        self.pending_lock = Lock()
         self.success_count = 0
+        self.metrics_server: MetricsServer | None = None
+        registry.gauge('jm_queue_depth', '队列中的任务数', ('type',),
+                       lambda: {(name,): self.task_queue.count(t) for t, name in TaskQueue.TYPES.items()})
         # 下载优先级
-        self.download_priority = sorted(
-            [(k, v) for k, v in self.cfg['download_priority'].items()], key=lambda x: x[1])
-        self.priority_func = {"comic": self.pop_comic_task_from_queue,
-                              "chapter": self.pop_chapter_task_from_queue,
-                              "img": self.pop_img_task_from_queue}
+        self.download_priority = self.get_download_priority(self.cfg['download_priority'])
         self.download_content = self.cfg.get("download_content", {})
+        # 任务类型对应的线程函数和协程函数
+        self.works = {"comic": self.work_home_data,
+                      "chapter": self.work_page_data,
+                      "img": self.work_img}
+        self.async_works = {"comic": self.async_work_home_data,
+                            "chapter": self.async_work_page_data,
+                            "img": self.async_work_img}
+        self.async_sessions: AsyncSessionPool = None
+        self.is_interrupt = False
+        # 每个host的连接池大小
+        session_pool.set_pool_size(self.cfg.get('session_pool_size', 10))
+        rate_limiter.set_rates(self.cfg.get('rate_limit', {}))
+        # 不需要重启就能生效的配置
+        for key in ('download_priority', 'proxies', 'rate_limit'):
+            self.cfg.subscribe(key, self.on_config_change)
+
+    @staticmethod
+    def get_download_priority(priority: dict) -> list[int]:
+        """配置的优先级转成任务类型列表，排在前面的先下载
+
+        Args:
+            priority (dict): {任务类型名: 优先级}
+
+        Returns:
+            list[int]: 任务类型列表
+        """
+        types = {v: k for k, v in TaskQueue.TYPES.items()}
+        return [types[k] for k, _ in sorted(priority.items(), key=lambda x: x[1])]
+
+    def on_config_change(self, key: str, value):
+        """配置修改后更新运行中的设置
+
+        proxies每次请求时读取配置，不需要额外处理
+        """
+        try:
+            if key == 'download_priority':
+                self.download_priority = self.get_download_priority(value)
+            elif key == 'rate_limit':
+                rate_limiter.set_rates(value)
+        except Exception as e:
+            logger.error(f'配置{key}更新失败: {e}')
+            return
+        logger.info(f'配置{key}已更新: {value}')
 
     def update_cookies(self) -> bool:
         """自动登录，获取cookie写入配置中
@@ -86,19 +188,17 @@ class JMSpider:
         return not (str(date.today()) == self.cfg.get('cookie_update', ''))
 
     @classmethod
-    @retry(sleep=1)
-    @count_sleep
-    def download_comic_page(cls, comicid: str, save_file: str, cookies: dict = None, page: int = None) -> bool:
+    @retry(policy=retry_policy)
+    def download_comic_page(cls, comicid: str, cookies: dict = None, page: int = None) -> bytes:
         """下载漫画页面
 
         Args:
             comicid (str): 漫画id
-            save_file (str): 保存文件
             cookies (dict, optional): 登录cookie. Defaults to None.
             page (int, optional): 下载哪一页. Defaults to None.
 
         Returns:
-            bool: _description_
+            bytes: 网页数据
         """
         if not cookies:
             cookies = {}
@@ -113,124 +213,57 @@ class JMSpider:
             url='https://18comic.org/photo/{}'.format(comicid),
             cookies=cookies,
             headers=cls._headers,
-            params=params
+            params=params,
+            limit_type='photo'
         )
 
-        return hc.get(save_file)
+        return hc.get(html_dump_file(f'{comicid}_page_{page or 1}.html'))
 
     @classmethod
-    def parse_comic_page(cls, html_file: str) -> dict:
+    def parse_comic_page(cls, html: bytes) -> dict:
         """解析漫画页面数据
 
         Args:
-            html_file (str): 网页文件
+            html (bytes): 网页数据
 
         Returns:
             dict: 解析数据
         """
+        return jmparser.parse_comic_page(html, cls._root_url)
 
-        with open(html_file, 'r', encoding='utf-8') as f:
-            html = f.read()
-        root_element = etree.HTML(html)
-        ret_data = {}
-
-        # 所有图片url
-        urls = root_element.xpath(
-            '//div[@class="center scramble-page"]/img/@data-original')
-        ret_data['urls'] = urls
-
-        # 漫画标题
-        title = root_element.xpath(
-            '//div[@class="container"]/div[@class="row"]/div/div[@class="panel panel-default"]/div[@class="panel-heading"]/div[@class="pull-left"]/text()')
-        if title:
-            title = title[0].replace('\n', '').strip()
-            ret_data['title'] = title
-
-        # 下一话id
-        next_comic = root_element.xpath(
-            '//i[@class="fas fa-angle-double-right"]/../@href')
-        if next_comic:
-            next_comic = next_comic[0].split('/')[-1].split('?')[0]
-            ret_data['next_comic'] = next_comic
-
-        # 上一话
-        previous_comic = root_element.xpath(
-            '//i[@class="fa fa-angle-double-left"]/../@href')
-        if previous_comic:
-            previous_comic = previous_comic[0].split('/')[-1].split('?')[0]
-            ret_data['previous_comic'] = previous_comic
-
-        # 获取最大页数
-        # 如果当前页面是最后一页，统计该漫画有多少页
-        curr_page = root_element.xpath(
-            '//div[@class="hidden-xs"]/ul[@class="pagination"]/li')
-        if curr_page:
-            # 当前页面如果是最后一页，会少一个跳到尾部的li标签，所以直接判断最后一个
-            if curr_page[-1].attrib.get('class', None):
-                max_page = curr_page[-1].xpath('span/text()')
-                ret_data['max_page'] = int(max_page[0])
-                ret_data['curr_page'] = len(
-                    ret_data['urls']) + (ret_data['max_page'] - 1) * 300
-            else:
-                # 不在最后一页，尾部会多个跳到尾部的li标签，所以倒数第二个才是最大页数
-                max_page = curr_page[-2].xpath('a/text()')
-                ret_data['max_page'] = int(max_page[0])
-                ret_data['curr_page'] = 0
-        else:  # 没有该标签表示没有分页
-            ret_data['curr_page'] = len(ret_data['urls'])
-            ret_data['max_page'] = 1
-
-        # 获取介绍页面链接
-        ret_data['home_url'] = None
-        home_url = root_element.xpath(
-            '//div[@class="menu-bolock hidden-xs hidden-sm"]/ul[2]/li[6]/a/@href')
-        if home_url and home_url[0] != 'javascript:void(0)':
-            ret_data['home_url'] = ''.join((cls._root_url, home_url[0]))
-
-        if not ret_data['home_url']:
-            home_url = root_element.xpath(
-                '//div[@class="menu-bolock hidden-xs hidden-sm"]/ul[2]/li[5]/a/@href')
-            if home_url:
-                ret_data['home_url'] = ''.join((cls._root_url, home_url[0]))
-
-        return ret_data
-
-    @retry(sleep=1)
-    @count_sleep
-    def download_comic_img(self, url: str, save_file: str) -> bool:
+    @retry(policy=retry_policy)
+    def download_comic_img(self, url: str) -> bytes:
         """下载图片
 
         Args:
             url (str): 图片url
-            save_file (str): 保存的文件路径
 
         Returns:
-            bool: 是否成功
+            bytes: 图片数据
         """
         proxies = self.cfg.get('proxies', None)
 
         itc = ImgTSLCrawler(url=url,
                             headers=self._headers,
                             cookies=None,
-                            proxies=proxies
+                            proxies=proxies,
+                            limit_type='img'
                             )
-        return itc.get(save_file)
+        return itc.get()
         
 
     @classmethod
-    @retry(sleep=1)
-    @count_sleep
-    def download_search_page(cls, page: int, search: str, save_file: str, cookies: dict = None) -> bool:
+    @retry(policy=retry_policy)
+    def download_search_page(cls, page: int, search: str, cookies: dict = None) -> bytes:
         """下载搜索页面
 
         Args:
             page (int): 获取搜索结果的哪一页
             search (str): 搜索内容
-            save_file (str): 提供网页文件保存位置
             cookies (dict, optional): 登录cookie. Defaults to None.
 
         Returns:
-            bool: 是否成功
+            bytes: 网页数据
         """
 
         if not cookies:
@@ -251,267 +284,228 @@ class JMSpider:
         hc = HtmlCrawler(url='https://18comic.org/search/photos',
                          params=params,
                          headers=cls._headers,
-                         cookies=cookies
+                         cookies=cookies,
+                         limit_type='search'
                          )
-        return hc.get(save_file)
+        return hc.get(html_dump_file(f'search_{page}.html'))
 
-    @retry(sleep=1)
-    @count_sleep
-    def download_home_page(self, url: str, save_file: str, cookies: dict = None) -> bool:
+    @retry(policy=retry_policy)
+    def download_home_page(self, url: str, cookies: dict = None) -> bytes:
         """下载comic详情页
         处理需要TSL指纹反爬的请求
 
         Args:
             url (str): 请求链接
-            save_file (str): 指定保存的文件
             cookies (dict, optional): 添加登录cookie. Defaults to None.
 
         Returns:
-            bool: 是否成功
+            bytes: 网页数据
         """
         # if not cookies:
         #     cookies = {}
         # cookies['_gali'] = 'wrapper'
 
-        headers = {
-            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,'
-            'application/signed-exchange;v=b3;q=0.7',
-            'accept-language': 'zh-CN,zh;q=0.9',
-            'sec-ch-ua': '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'document',
-            'sec-fetch-mode': 'navigate',
-            'sec-fetch-site': 'none',
-            'sec-fetch-user': '?1',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 '
-                      'Safari/537.36',
-            'authority': '18comic.vip',
-            'origin': 'https://18comic.vip',
-            'referer': 'https://18comic.vip'
-        }
         proxies = self.cfg.get('proxies', None)
 
         hc = HtmlTSLCrawler(url=url,
-                            headers=headers,
+                            headers=self._home_headers,
                             cookies=cookies,
-                            proxies=proxies
+                            proxies=proxies,
+                            limit_type='album'
                             )
-        return hc.get(save_file)
+        return hc.get(html_dump_file(f'home_{url.split("//")[-1]}.html'))
 
-    def parse_home_page(self, html_file: str) -> dict:
+    @retry(policy=retry_policy)
+    async def async_download_comic_page(self, comicid: str, cookies: dict = None, page: int = None) -> bytes:
+        """下载漫画页面，download_comic_page的协程版本
+        """
+        if not cookies:
+            cookies = {}
+
+        params = {}
+        if page:
+            params = {
+                'page': '{}'.format(page),
+            }
+
+        hc = AsyncHtmlTSLCrawler(
+            url='https://18comic.org/photo/{}'.format(comicid),
+            sessions=self.async_sessions,
+            cookies=cookies,
+            headers=self._headers,
+            params=params,
+            proxies=self.cfg.get('proxies', None),
+            limit_type='photo'
+        )
+        return await hc.get(html_dump_file(f'{comicid}_page_{page or 1}.html'))
+
+    @retry(policy=retry_policy)
+    async def async_download_comic_img(self, url: str) -> bytes:
+        """下载图片，download_comic_img的协程版本
+        """
+        itc = AsyncImgTSLCrawler(url=url,
+                                 sessions=self.async_sessions,
+                                 headers=self._headers,
+                                 cookies=None,
+                                 proxies=self.cfg.get('proxies', None),
+                                 limit_type='img'
+                                 )
+        return await itc.get()
+
+    @retry(policy=retry_policy)
+    async def async_download_home_page(self, url: str, cookies: dict = None) -> bytes:
+        """下载comic详情页，download_home_page的协程版本
+        """
+        hc = AsyncHtmlTSLCrawler(url=url,
+                                 sessions=self.async_sessions,
+                                 headers=self._home_headers,
+                                 cookies=cookies,
+                                 proxies=self.cfg.get('proxies', None),
+                                 limit_type='album'
+                                 )
+        return await hc.get(html_dump_file(f'home_{url.split("//")[-1]}.html'))
+
+    def parse_home_page(self, html: bytes) -> dict:
         """解析主页数据
 
         Args:
-            html_file (str): 网页文件
+            html (bytes): 网页数据
 
         Returns:
             dict: 解析结果
         """
-        with open(html_file, 'r', encoding='utf-8') as f:
-            html = f.read()
-
-        root_element = etree.HTML(html)
-        res_list = {}
-
-        res_list['url'] = ''
-        url = root_element.xpath('//*[@property="og:url"]/@content')
-        if url:
-            res_list['url'] = url[0]
-
-        res_list['title'] = ''
-        title = root_element.xpath(
-            '//div[@class="panel-heading"]/div[@itemprop="name"]/h1/text()')
-        if title:
-            res_list['title'] = title[0]
-
-        res_list['comicid'] = None
-        comicid = root_element.xpath(
-            '//div[@class="panel-body"]/div/div[2]/div[1]/div[1]/text()')
-        if comicid:
-            comp = re.compile(r'JM(\d+)')
-            res = re.findall(comp, comicid[0])
-            if res:
-                res_list['comicid'] = int(res[0])
-
-        res_list['tags'] = None
-        tags = root_element.xpath(
-            '//div[@class="panel-body"]/div/div[2]/div[1]/div[4]/span[@data-type="tags"]/a/text()')
-        if tags:
-            res_list['tags'] = tags
-
-        res_list['author'] = None
-        author = root_element.xpath(
-            '//div[@class="panel-body"]/div/div[2]/div[1]/div[5]/span/a/text()')
-        if author:
-            res_list['author'] = author
-
-        res_list['description'] = ''
-        description = root_element.xpath(
-            '//div[@class="panel-body"]/div/div[2]/div[1]/div[8]/text()')
-        if description:
-            comp = re.compile(r'敘述：(.*)', re.DOTALL)
-            res = re.findall(comp, description[0])
-            if res:
-                res_list['description'] = res[0]
-
-        res_list['page'] = 0
-        page = root_element.xpath(
-            '//div[@class="panel-body"]/div/div[2]/div[1]/div[9]/text()')
-        if page:
-            comp = re.compile(r'頁數：(\d+)')
-            res = re.findall(comp, page[0])
-            if res:
-                res_list['page'] = int(res[0])
-
-        res_list['next'] = None
-        next = root_element.xpath(
-            '//div[@class="panel-body"]/div/div[2]/div[3]/div//ul/a/@data-album')
-        if next:
-            res_list['next'] = next
-
-        return res_list
+        return jmparser.parse_home_page(html)
 
     @classmethod
-    def parse_search_page(cls, html_file: str, filter: list = None) -> list:
-        """解析搜索页面
+    def parse_search_page(cls, html: bytes, filter: list = None) -> dict:
+        """解析搜索页面，漫画列表和总页数只需解析一次网页
 
         Args:
-            html_file (str): 网页文件
+            html (bytes): 网页数据
             filter (list, optional): 过滤tag. Defaults to None.
 
         Returns:
-            list: 解析结果 [[漫画id, 漫画主页链接],...]
+            dict: {'comics': [[漫画id, 漫画主页链接],...], 'tags': {漫画id: [tag,...]}, 'total_page': 总页数}
         """
+        return jmparser.parse_search_page(html, cls._root_url, filter)
 
-        with open(html_file, 'r', encoding='utf-8') as f:
-            html = f.read()
-
-        root_element = etree.HTML(html)
-        res_list = []
-        divs_1 = root_element.xpath('//div[@class="row m-0"]/div')
-        divs_2 = root_element.xpath(
-            '//div[@class="container"]/div[3]/div/div/div')
-        if divs_2:
-            divs_1.extend(divs_2)
-
-        for i in divs_1:
-            comic_url = i.xpath('div/a/@href')
-            if not comic_url:
-                continue
-            comicid = comic_url[0].split('/')[-2]
-            comic_url = ''.join((cls._root_url, comic_url[0]))
-
-            # 判断是否过滤
-            if filter:
-                a_tags = i.xpath('div/div[2]//a/text()')
-                if set(filter) & set(a_tags):
-                    continue
-            res_list.append([comicid, comic_url])
-
-        return res_list
+    def _run_steps(self, steps) -> dict:
+        """在当前线程执行任务流程
 
-    @staticmethod
-    def parse_search_total_page(html_file: str) -> int:
-        """解析搜索页面的页数
+        流程通过yield (操作, 参数) 请求网络和阻塞操作，这里直接调用对应的下载函数，
+        异常传回流程处理，流程结束时返回结果
 
         Args:
-            html_file (str): 网站文件
+            steps (Generator): _img_steps等任务流程
 
         Returns:
-            int: 总页数
+            dict: 任务结果
         """
-        with open(html_file, 'r', encoding='utf-8') as f:
-            html = f.read()
-        root_element = etree.HTML(html)
-        page = 1
-        '''
-        页数栏会根据不同页数发生变化，这里对每种变化都处理
-        '''
-        data = root_element.xpath('//ul[@class="pagination"]/li[8]/a/text()')
-        if data and data[0] == '»':
-            data = root_element.xpath(
-                '//ul[@class="pagination"]/li[5]/a/text()')
-        if data and data[0].isdecimal():
-            page = int(data[0])
-
-        data = root_element.xpath('//ul[@class="pagination"]/li[9]/a/text()')
-        if data and data[0].isdecimal():
-            if int(data[0]) > page:
-                page = int(data[0])
-
-        data = root_element.xpath(
-            '//ul[@class="pagination"]/li[8]/span/text()')
-        if data and data[0].isdecimal():
-            if int(data[0]) > page:
-                page = int(data[0])
-
-        return page
-
-    def work_img(self, comicid: int, url: str, img_path: str) -> dict:
-        """下载图片线程函数
+        calls = {'page': self.download_comic_page,
+                 'home': self.download_home_page,
+                 'img': self.download_comic_img,
+                 'call': lambda func, *args: func(*args)}
+        try:
+            op, args = next(steps)
+            while True:
+                try:
+                    value = calls[op](*args)
+                except Exception as e:
+                    op, args = steps.throw(e)
+                else:
+                    op, args = steps.send(value)
+        except StopIteration as e:
+            return e.value
+        finally:
+            # 在线程池中执行，任务完成后释放该线程的数据库连接
+            db.remove()
 
-        Args:
-            comicid (int): 漫画id
-            url (str): 下载url
+    @staticmethod
+    def _call_and_release(func, *args):
+        try:
+            return func(*args)
+        finally:
+            db.remove()
 
-        Returns:
-            dict: 返回{'comicid': 漫画id, 'type': 2, 'img_path':下载路径}
+    def to_thread(self, func, *args):
+        """协程模式中在线程执行阻塞的函数，执行完释放该线程的数据库连接
+        """
+        return asyncio.to_thread(self._call_and_release, func, *args)
+
+    async def _async_run_steps(self, steps) -> dict:
+        """在事件循环中执行任务流程，_run_steps的协程版本
+
+        下载使用协程版本的下载函数，阻塞操作交给线程执行
         """
-        result = {'success': False, 'comicid': comicid, 'type': 2}
-        is_fail = False
+        calls = {'page': self.async_download_comic_page,
+                 'home': self.async_download_home_page,
+                 'img': self.async_download_comic_img,
+                 'call': self.to_thread}
         try:
-            res = self.download_comic_img(url, img_path)
-            if res:
-                # 还原下载的图片
-                if comicid >= self._transform_id:
-                    if r'.gif' != url[-4:]:  # 图片是gif格式的，不用还原
-                        JMImgHandle.restore_img(str(comicid), os.path.basename(
-                            img_path).split('.')[0], img_path)
-            else:
-                logger.warning(f'{comicid} 下载图片失败, [url]: {url}')
-                is_fail = True
+            op, args = next(steps)
+            while True:
+                try:
+                    value = await calls[op](*args)
+                except Exception as e:
+                    op, args = steps.throw(e)
+                else:
+                    op, args = steps.send(value)
+        except StopIteration as e:
+            return e.value
+
+    def _img_steps(self, comicid: int, url: str, img_path: str, page: int):
+        """下载图片的流程，线程和协程模式共用
+        """
+        result = {'success': False, 'comicid': comicid, 'type': 2, 'page': page}
+        try:
+            content = yield 'img', (url,)
         except Exception as e:
             logger.warning(
                 f'{comicid} 下载图片发生错误 [url]: {url}, [error]: {e}')
-            is_fail = True
+            # 只有下载的错误可能是永久错误
+            result['permanent'] = retry_policy.is_permanent(e)
+            return result
+        if not content:
+            logger.warning(f'{comicid} 下载图片失败, [url]: {url}')
+            return result
 
-        if is_fail:
-            comicimg = query_comicimg_by_url(self.db, comicid, url)
-            page = query_comicimg_arr(self.db, comicimg, ComicImg.page)
-            result['page'] = page[0]
+        try:
+            # 下载后在内存中还原图片，只编码一次，图片转码比较耗时，交给进程池
+            start = time.perf_counter()
+            cost = yield 'call', (self.cpu_pool.run, JMImgHandle.save_img, content, img_path,
+                                  self.get_img_slices(comicid, url, img_path))
+            IMG_SAVE_SECONDS.observe(cost)
+            IMG_QUEUE_SECONDS.observe(max(time.perf_counter() - start - cost, 0))
+            self.file_index.add(img_path)
+        except Exception as e:
+            logger.warning(
+                f'{comicid} 保存图片发生错误 [path]: {img_path}, [error]: {e}')
+            if self.cpu_pool.broken and not self.is_interrupt:
+                # 进程池无法恢复，继续下载的图片都不能保存
+                logger.error('图片处理进程池多次崩溃，停止下载')
+                self.is_interrupt = True
             return result
 
         result['success'] = True
         return result
 
-    def work_page_data(self, comicid: int) -> dict:
-        """下载漫画页面数据并添加到数据库
-        线程函数
-
-        Args:
-            comicid (int): 漫画id
-
-        Returns:
-            dict: 返回{'comicid': comicid, 'type': 1}
+    def _page_data_steps(self, comicid: int):
+        """下载漫画页面数据并添加到数据库的流程，线程和协程模式共用
         """
         logger.info(f'{comicid} 下载页数数据')
         is_error = False
-        tmp_file = os.path.join(TMP_DIR, f'{comicid}_page.html')
         result = {'success': False, 'comicid': comicid, 'type': 1}
         try:
-            res = self.download_comic_page(
-                str(comicid), tmp_file, self.cfg.get('cookie', None))
+            res = yield 'page', (str(comicid), self.cfg.get('cookie', None))
             if res:
-                page_data = self.parse_comic_page(tmp_file)
+                page_data = self.parse_comic_page(res)
                 # 漫画超过300张会分页显示
                 page = 1
                 while page_data['max_page'] > page:
                     page += 1
-                    res = self.download_comic_page(str(comicid), tmp_file, self.cfg.get(
-                        'cookie', None), page)
+                    res = yield 'page', (str(comicid), self.cfg.get('cookie', None), page)
                     if res:
-                        tmp_data = self.parse_comic_page(tmp_file)
+                        tmp_data = self.parse_comic_page(res)
                         page_data['urls'].extend(tmp_data['urls'])
                         page_data['curr_page'] = len(page_data['urls'])
                     else:
@@ -521,40 +515,27 @@ class JMSpider:
                 if not is_error:
                     if page_data['curr_page'] == 0:
                         raise ValueError(f'{comicid} 页面解析出错')
-                    self.page_data_to_db(comicid, page_data)
+                    yield 'call', (self.page_data_to_db, comicid, page_data)
                     logger.info(f'{comicid} 下载页数数据成功。')
 
         except Exception as e:
             logger.error(f'{comicid} 页面可能不存在或者需要登录。error:{e}')
             return result
-        finally:
-            if os.path.exists(tmp_file):
-                os.unlink(tmp_file)
 
         result['success'] = True
         return result
 
-    def work_home_data(self, comicid: int, url: str) -> dict:
-        """下载漫画主页数据并添加到数据库
-        线程函数
-
-        Args:
-            comicid (int): 漫画id
-            url (str): 主页链接
-
-        Returns:
-            dict: 返回{'comicid': 漫画id, 'type':0}
+    def _home_data_steps(self, comicid: int, url: str):
+        """下载漫画主页数据并添加到数据库的流程，线程和协程模式共用
         """
         logger.info(f'{comicid} 下载主页数据')
-        tmp_file = os.path.join(TMP_DIR, f'{comicid}_home.html')
         result = {'success': False, 'comicid': comicid,
                   'type': 0, 'is_del': False}
         try:
             if not url:
-                res = self.download_comic_page(
-                    str(comicid), tmp_file, self.cfg.get('cookie', None))
+                res = yield 'page', (str(comicid), self.cfg.get('cookie', None))
                 if res:
-                    page_data = self.parse_comic_page(tmp_file)
+                    page_data = self.parse_comic_page(res)
                     # https://18comic.org/javascript:void(0)
                     url = page_data['home_url']
                     if page_data.get('previous_comic', None):
@@ -565,16 +546,15 @@ class JMSpider:
             if not url:
                 raise ValueError('url为空')
 
-            res = self.download_home_page(
-                url, tmp_file, self.cfg.get('cookie', None))
+            res = yield 'home', (url, self.cfg.get('cookie', None))
             if res:
-                home_data = self.parse_home_page(tmp_file)
+                home_data = self.parse_home_page(res)
                 if home_data['page'] != 0:
                     if home_data['comicid'] != comicid:
                         logger.warning(f'{comicid} 不是漫画id，是章节id')
                         result['is_del'] = True
                         return result
-                    home_data_to_db(self.db, home_data)
+                    yield 'call', (home_data_to_db, self.db, home_data)
                     logger.info(f'{comicid} 下载主页数据成功。')
                     result['success'] = True
                     return result
@@ -584,72 +564,192 @@ class JMSpider:
         except Exception as e:
             logger.error(f'{comicid} 下载主页数据出错。error:{e}')
             return result
-        finally:
-            if os.path.exists(tmp_file):
-                os.unlink(tmp_file)
 
         return result
 
-    def search(self, key: str, max: int = 0):
-        """搜索，结果保存到数据库
+    def work_img(self, comicid: int, url: str, img_path: str, page: int) -> dict:
+        """下载图片线程函数
 
         Args:
-            key (str): _description_
-            max (int, optional): _description_. Defaults to 0.
+            comicid (int): 漫画id
+            url (str): 下载url
+            img_path (str): 保存路径
+            page (int): 图片页数
+
+        Returns:
+            dict: 返回{'comicid': 漫画id, 'type': 2, 'page': 图片页数}，
+                  永久错误时'permanent'为True，不再重新下载
         """
-        cookies = self.cfg.get("cookie", None)
-        html_file = os.path.join(TMP_DIR, "search.html")
-        page = 1
-        max_page = 1
+        return self._run_steps(self._img_steps(comicid, url, img_path, page))
 
-        logger.info(f'开始搜索[{key}]')
-        with tqdm() as pbar:
-            while True:
-                res = self.download_search_page(
-                    page=page, search=key, cookies=cookies, save_file=html_file)
-                if res:
-                    # 每次都更新最大页数
-                    count = self.parse_search_total_page(html_file)
-                    if count > max_page:
-                        max_page = count
-                    pbar.total = max_page
-                    if max > 0 and max_page > max:
-                        logger.info(f'搜索结果共{max_page}页, 只获取{max}页')
-                        max_page = max
-                    else:
-                        if count == max_page:
-                            logger.info(f'搜索结果共{max_page}页')
+    def work_page_data(self, comicid: int) -> dict:
+        """下载漫画页面数据并添加到数据库
+        线程函数
 
-                    search_data = self.parse_search_page(
-                        html_file, self.cfg.get('filter_tag', None))
-                    search_data = list_deduplication(search_data)  # 去重
-                    search_data_to_db(self.db, search_data)
+        Args:
+            comicid (int): 漫画id
 
-                else:
-                    logger.warning(f'获取搜索页面失败 [key]:{key}, [page]:{page}')
+        Returns:
+            dict: 返回{'comicid': comicid, 'type': 1}
+        """
+        return self._run_steps(self._page_data_steps(comicid))
 
-                pbar.update(1)
+    def work_home_data(self, comicid: int, url: str) -> dict:
+        """下载漫画主页数据并添加到数据库
+        线程函数
+
+        Args:
+            comicid (int): 漫画id
+            url (str): 主页链接
+
+        Returns:
+            dict: 返回{'comicid': 漫画id, 'type':0}
+        """
+        return self._run_steps(self._home_data_steps(comicid, url))
+
+    async def async_work_img(self, comicid: int, url: str, img_path: str, page: int) -> dict:
+        """下载图片协程函数，返回值和work_img相同
+        """
+        return await self._async_run_steps(self._img_steps(comicid, url, img_path, page))
+
+    async def async_work_page_data(self, comicid: int) -> dict:
+        """下载漫画页面数据并添加到数据库
+        协程函数，返回值和work_page_data相同
+        """
+        return await self._async_run_steps(self._page_data_steps(comicid))
+
+    async def async_work_home_data(self, comicid: int, url: str) -> dict:
+        """下载漫画主页数据并添加到数据库
+        协程函数，返回值和work_home_data相同
+        """
+        return await self._async_run_steps(self._home_data_steps(comicid, url))
+
+    def search(self, key: str, max_pages: int = 0) -> bool:
+        """搜索，结果保存到数据库
+
+        第一页得到总页数后，其余页并发下载，解析结果分批写入数据库。
+        已完成的页会记录到数据库，中断后再搜索同一内容只下载剩余的页。
 
-                if page >= max_page:
-                    break
-                page += 1
+        Args:
+            key (str): 搜索内容
+            max_pages (int, optional): 最多获取的页数，0表示全部. Defaults to 0.
 
-        if os.path.exists(html_file):
-            os.unlink(html_file)
+        Returns:
+            bool: 是否所有页都完成
+        """
+        cookies = self.cfg.get("cookie", None)
+        filter_tag = self.cfg.get('filter_tag', None)
+        batch_size = self.cfg.get('search_batch_size', 20)
+        done = query_search_pages(self.db, key)  # 已完成的页 {页数: 总页数}
+        max_page = max(done.values(), default=1)
+        if max_pages > 0:
+            max_page = min(max_page, max_pages)
+        if done:
+            logger.info(f'继续搜索[{key}], 已完成{len(done)}页')
+        else:
+            logger.info(f'开始搜索[{key}]')
+
+        def fetch(page: int) -> dict:
+            res = self.download_search_page(page=page, search=key, cookies=cookies)
+            return self.parse_search_page(res, filter_tag)
+
+        search_pool = MyTheadingPool(max=self.cfg.get('search_thread_max', 5))
+        futures: dict[Future, int] = {}  # {future: 页数}
+        submitted = set(done)
+        data, pages = [], []  # 等待写入数据库的数据
+        fail_count = 0
+
+        def submit(max_page: int):
+            for page in range(1, max_page + 1):
+                if page not in submitted:
+                    submitted.add(page)
+                    futures[search_pool.add_task(fetch, page)] = page
+
+        def flush():
+            if pages:
+                search_data_to_db(self.db, list_deduplication(data), key, pages)
+                data.clear()
+                pages.clear()
+
+        # 没有记录总页数时，先只下载第一页
+        submit(max_page if done else 1)
+        try:
+            with tqdm(total=max_page, initial=len(done)) as pbar:
+                while futures:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        page = futures.pop(future)
+                        try:
+                            search_result = future.result()
+                        except Exception as e:
+                            logger.error(f'下载搜索页面出错 [key]:{key}, [page]:{page}, [error]:{e}')
+                            fail_count += 1
+                            pbar.update(1)
+                            continue
+                        data.extend(search_result['comics'])
+                        pages.append((page, search_result['total_page']))
+                        pbar.update(1)
+
+                        # 每页都可能更新总页数
+                        count = search_result['total_page']
+                        if count > max_page and not (max_pages > 0 and max_page >= max_pages):
+                            if max_pages > 0 and count > max_pages:
+                                logger.info(f'搜索结果共{count}页, 只获取{max_pages}页')
+                            else:
+                                logger.info(f'搜索结果共{count}页')
+                            max_page = min(count, max_pages) if max_pages > 0 else count
+                            pbar.total = max_page
+                            pbar.refresh()
+                            submit(max_page)
+
+                    if len(pages) >= batch_size or not futures:
+                        flush()
+        finally:
+            search_pool.close()
+
+        if fail_count:
+            logger.warning(f'搜索[{key}]有{fail_count}页失败, 再次搜索会继续下载失败的页')
+            return False
+        del_search_pages(self.db, key)
         logger.info(f'搜索[{key}]完成')
+        return True
 
     def zip_comic(self, comicids: list) -> list:
         '''根据id列表打包漫画
+
+        zip_mode为single时所有漫画打包到out_zip，
+        为zip或cbz时每部漫画单独打包到out_zip_dir，多部漫画同时打包
+
+        Returns:
+            list: 生成的压缩包
         '''
         if not comicids:
             return []
-        comicids = list(set(comicids))
-        dirs = self.cfg.get('save_dir', [])
-        zip_dirs = JMDirHandle.get_comics_dirs(comicids, dirs)
-        if comicids:
-            logger.warning(f'打包过程中，出现找到对应的文件 {" ".join(comicids)}')
-        out_file = self.cfg.get('out_zip', 'jmcomic.zip')
-        JMDirHandle.zip_dir(zip_dirs, out_file)
+        self.dir_index.refresh()
+        zip_dirs, missing = self.dir_index.get_many(set(comicids))
+        if missing:
+            logger.warning(f'打包过程中，没有找到对应的目录 {" ".join(missing)}')
+        # jpg已经是压缩过的，默认只存储
+        compression = ZIP_DEFLATED if self.cfg.get('zip_compress', False) else ZIP_STORED
+        mode = self.cfg.get('zip_mode', 'single')
+        if mode == 'single':
+            out_file = self.cfg.get('out_zip', '') or 'jmcomic.zip'
+            JMDirHandle.zip_dir(zip_dirs, out_file, compression)
+            return [out_file]
+        out_dir = self.cfg.get('out_zip_dir', '') or os.path.join('.', 'zip')
+        return JMDirHandle.zip_dirs(zip_dirs, out_dir, f'.{mode}', compression,
+                                    self.cfg.get('zip_thread_max', 0))
+
+    def get_save_dirs(self) -> list[str]:
+        """所有保存漫画的根目录
+
+        save_dir可以是一个目录或者目录列表，新下载的漫画保存在第一个目录，
+        library_dirs是其他存放漫画的目录，只用于查找
+        """
+        save_dir = self.cfg.get('save_dir', '')
+        dirs = [save_dir] if isinstance(save_dir, str) else list(save_dir)
+        dirs.extend(self.cfg.get('library_dirs', []))
+        return [dir for dir in dirs if dir]
 
     def get_comic_dir(self, comicid: int, title: str) -> str:
         """根据id和标题返回文件夹
@@ -659,6 +759,8 @@ class JMSpider:
             title (str): 漫画标题(数据库的chapter_titile列)
         """
         save_dir = self.cfg.get('save_dir', os.path.abspath('.'))
+        if not isinstance(save_dir, str):
+            save_dir = save_dir[0] if save_dir else os.path.abspath('.')
         return JMDirHandle.create_comic_dir(comicid, title, save_dir)
 
     def check_search(self):
@@ -669,8 +771,8 @@ class JMSpider:
         if search_dict:
             key = search_dict.get('key', '')
             max_page = search_dict.get('max_page', 0)
-            if key:
-                self.search(key, max_page)
+            # 没有完成时保留配置，下次运行继续搜索
+            if key and self.search(key, max_page):
                 self.cfg['search'] = {"key": "", "max_page": 0}
 
     def download_comic_3(self):
@@ -681,22 +783,17 @@ class JMSpider:
         logger.info(f'当前系统是: {os_name}')
 
         # 启动ctrl+c信号监听
-        is_interrupt = False
+        self.listen_interrupt()
+        self.start_metrics_server()
 
-        def handler(sigint_obg: MySigint):
-            print("接收到Ctrl+C信号")
-            logger.info("接收到Ctrl+C信号")
-            nonlocal is_interrupt
-            is_interrupt = True
-            sigint_obg.stop()
-        mysigint = MySigint()
-        res = mysigint.listening(handler, mysigint)
-        if res:
-            print('开始监听ctrl+c信号')
-            logger.info('开始监听ctrl+c信号')
-        else:
-            print('监听ctrl+c信号失败')
-            logger.warning('监听ctrl+c信号失败')
+        # 任务完成或结果处理完时唤醒主循环
+        self.wakeup = Event()
+        self.coordinator = MyCoordinator(self.handle_results,
+                                         on_batch=self.wakeup.set,
+                                         logger=logger)
+
+        # 上次未完成的任务
+        self.load_task_queue()
 
         # 数据库中未完成的漫画
         comics = query_static(self.db, 0)
@@ -709,56 +806,209 @@ class JMSpider:
         progress_log_time = self.cfg.get('progress_log', 60)
         start_time = time.time()
         tmp_time = start_time
-        while not is_interrupt:
-            while comics and self.queue_count() < 100 and comic_index < len(comics) and not is_interrupt:
-                static = queue_comic_arr(
-                    self.db, comics[comic_index], Comic.static)
-                if static == 1:
-                    comics.remove(comics[comic_index])
-                else:
-                    comicid = queue_comic_arr(
-                        self.db, comics[comic_index], Comic.comicid)
-                    if comicid:
-                        try:
-                            self.check_comic(comicid[0])
-                        except Exception as e:
-                            logger.error(
-                                f'{comicid[0]} check_comic出错. {e}')
-                comic_index += 1
+        print_time = 0
+        while not self.is_interrupt:
+            comic_index = self.check_comics(comics, comic_index)
 
             # self.check_comic(450324)
 
             self.task_to_pool()
-            if len(self.pool.futures) == 0 and self.is_empty_queue():
+            self.save_task_queue()
+            if len(self.pool.futures) == 0 and self.coordinator.idle() and self.is_empty_queue():
                 # 没有任务
                 break
 
-            # 等待处理，延时
-            try:
-                self.pool.wait(timeout=1, logger=logger)
-            except TimeoutError:
-                pass
-            else:
-                time.sleep(1)
+            # 有任务完成或者有结果处理完，就马上补充任务
+            self.wakeup.wait(timeout=1)
+            self.wakeup.clear()
+            self.pool.collect_done(logger=logger)
 
-            # 输出log
-            if os_name != "Linux":
-                clean_previous_line()
-            print(
-                f'完成数: { self.success_count} 线程任务数: {len(self.pool.futures)} 剩余任务数: {self.queue_count()}')
+            # 输出log，最多每秒一次
             end_time = time.time()
+            if end_time - print_time >= 1:
+                if os_name != "Linux":
+                    clean_previous_line()
+                print(self.progress_info(len(self.pool.futures)))
+                print_time = end_time
+                # 配置文件在外部修改时重新加载
+                self.cfg.reload()
             if end_time - tmp_time >= progress_log_time:
-                logger.info(
-                    f'完成数: { self.success_count} 线程任务数: {len(self.pool.futures)} 剩余任务数: {self.queue_count()}')
+                logger.info(self.progress_info(len(self.pool.futures)))
+                self.log_metrics()
                 tmp_time = end_time
 
         print('Stoping')
         logger.info('Stoping')
         self.pool.wait(logger=logger)
         self.pool.close()
-        
-        logger.info(
-            f'完成数: { self.success_count} 线程任务数: {len(self.pool.futures)} 剩余任务数: {self.queue_count()}')
+        self.coordinator.close()
+        self.cpu_pool.close()
+        session_pool.close()
+        self.close_metrics_server()
+        self.save_task_queue()
+
+        self.log_finish(len(self.pool.futures), start_time)
+
+    def download_comic_async(self):
+        """协程模式下载，流程和download_comic_3相同
+
+        每种任务的并发数由配置async_limit设置
+        """
+        asyncio.run(self._download_comic_async())
+
+    async def _download_comic_async(self):
+        import platform
+        os_name = platform.system()
+        logger.info(f'当前系统是: {os_name}')
+
+        self.listen_interrupt()
+        self.start_metrics_server()
+
+        limits = {'comic': 5, 'chapter': 10, 'img': 100}
+        limits.update(self.cfg.get('async_limit', {}))
+        pool = MyAsyncPool(limits)
+        self.async_sessions = AsyncSessionPool(max_clients=pool.max_tasks())
+
+        await self.to_thread(self.load_task_queue)
+        comics = await self.to_thread(query_static, self.db, 0)
+        comic_index = 0
+        logger.info(f'未完成的漫画数:{len(comics)}')
+
+        print('Starting')
+        logger.info('Starting')
+        progress_log_time = self.cfg.get('progress_log', 60)
+        start_time = time.time()
+        tmp_time = start_time
+        print_time = 0
+        while not self.is_interrupt:
+            comic_index = await self.to_thread(self.check_comics, comics, comic_index)
+
+            # 保持等待中的协程数不超过所有类型并发数之和
+            count = pool.max_tasks() - len(pool.tasks)
+            if count > 0:
+                tasks = await self.to_thread(self.pop_works, count)
+                for task in tasks:
+                    pool.add_task(task[0], self.async_works[task[0]], *task[1])
+            await self.to_thread(self.save_task_queue)
+
+            if len(pool.tasks) == 0 and self.is_empty_queue():
+                break
+
+            if pool.tasks:
+                done = await pool.wait(timeout=1, logger=logger, return_when=asyncio.FIRST_COMPLETED)
+                await self.async_callback(done)
+            else:
+                await asyncio.sleep(1)
+
+            end_time = time.time()
+            if end_time - print_time >= 1:
+                if os_name != "Linux":
+                    clean_previous_line()
+                print(self.progress_info(len(pool.tasks)))
+                print_time = end_time
+                self.cfg.reload()
+            if end_time - tmp_time >= progress_log_time:
+                logger.info(self.progress_info(len(pool.tasks)))
+                self.log_metrics()
+                tmp_time = end_time
+
+        print('Stoping')
+        logger.info('Stoping')
+        while pool.tasks:
+            done = await pool.wait(logger=logger)
+            await self.async_callback(done)
+        await pool.close()
+        await self.async_sessions.close()
+        self.cpu_pool.close()
+        self.close_metrics_server()
+        await self.to_thread(self.save_task_queue)
+
+        self.log_finish(len(pool.tasks), start_time)
+
+    async def async_callback(self, tasks: set[asyncio.Task]):
+        """在线程中批量处理完成任务的结果，避免数据库操作阻塞事件循环
+        """
+        results = [task.result() for task in tasks
+                   if not task.cancelled() and not task.exception()]
+        if not results:
+            return
+        try:
+            await self.to_thread(self.handle_results, results)
+        except Exception as e:
+            logger.error(e)
+
+    def listen_interrupt(self):
+        """启动ctrl+c信号监听，收到信号后is_interrupt置为True
+        """
+        self.is_interrupt = False
+
+        def handler(sigint_obg: MySigint):
+            print("接收到Ctrl+C信号")
+            logger.info("接收到Ctrl+C信号")
+            self.is_interrupt = True
+            sigint_obg.stop()
+        mysigint = MySigint()
+        res = mysigint.listening(handler, mysigint)
+        if res:
+            print('开始监听ctrl+c信号')
+            logger.info('开始监听ctrl+c信号')
+        else:
+            print('监听ctrl+c信号失败')
+            logger.warning('监听ctrl+c信号失败')
+
+    def start_metrics_server(self):
+        """启动统计接口 http://127.0.0.1:{metrics_port}/metrics，端口为0时不启动
+        """
+        port = self.cfg.get('metrics_port', 9108)
+        if not port or self.metrics_server:
+            return
+        try:
+            self.metrics_server = MetricsServer(registry, port)
+        except OSError as e:
+            logger.error(f'统计接口启动失败, [port]: {port} {e}')
+            return
+        self.metrics_server.start()
+        logger.info(f'统计接口: http://127.0.0.1:{port}/metrics')
+
+    def close_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+    @staticmethod
+    def log_metrics():
+        """统计数据以json格式输出到日志
+        """
+        logger.info(f'metrics {json.dumps(registry.snapshot(), ensure_ascii=False)}')
+
+    def check_comics(self, comics: list[Comic], comic_index: int) -> int:
+        """检查未完成的漫画，添加任务到队列，直到队列任务数达到100
+
+        Returns:
+            int: 下一次检查的位置
+        """
+        while comics and self.queue_count() < 100 and comic_index < len(comics) and not self.is_interrupt:
+            static = queue_comic_arr(
+                self.db, comics[comic_index], Comic.static)
+            if static == 1:
+                comics.remove(comics[comic_index])
+            else:
+                comicid = queue_comic_arr(
+                    self.db, comics[comic_index], Comic.comicid)
+                if comicid and comicid[0] not in self.walked_comics:
+                    try:
+                        self.check_comic(comicid[0])
+                    except Exception as e:
+                        logger.error(
+                            f'{comicid[0]} check_comic出错. {e}')
+            comic_index += 1
+        return comic_index
+
+    def progress_info(self, running_count: int) -> str:
+        return f'完成数: { self.success_count} 线程任务数: {running_count} 剩余任务数: {self.queue_count()}'
+
+    def log_finish(self, running_count: int, start_time: float):
+        logger.info(self.progress_info(running_count))
         if self.queue_count() > 0:
             print(self.task_queue)
             logger.info(self.task_queue)
@@ -770,75 +1020,132 @@ class JMSpider:
         execution_time %= 60
         seconds = execution_time
         logger.info(f'总运行时间: {hours:02d}时{minutes:02d}分{seconds:02.2f}秒')
+        logger.info(f'请求重试统计: {retry_policy.stats()}')
 
     def task_to_pool(self) -> bool:
+        """补充任务到线程池，使提交的任务数保持在max_running
+
+        max_running大于线程数，线程完成任务后马上就有下一个任务
+        """
         is_add = False
-        if len(self.pool.futures) <= 5:
-            for _ in range(10):
-                task = self.pop_task_from_queue()
-                if not task:
-                    break
+        count = self.max_running - len(self.pool.futures)
+        if count > 0:
+            for task in self.pop_works(count):
                 is_add = True
-                if task[0] == 0:
-                    url = ''
-                    comic = query_comic(self.db, task[1])
-                    if comic:
-                        url = comic.url
-                    future = self.pool.add_task(
-                        self.work_home_data, task[1], url)
-                    if future:
-                        future.add_done_callback(self.callback_download)
-                elif task[0] == 1:
-                    future = self.pool.add_task(self.work_page_data, task[1])
-                    if future:
-                        future.add_done_callback(self.callback_download)
-                elif task[0] == 2:
-                    comicimg = query_comicimg(self.db, task[1][0], task[1][1])
-                    url = query_comicimg_arr(self.db, comicimg, ComicImg.url)
-                    url = url[0]
-                    img_path = self.get_img_path(task[1][0], url)
-                    if not os.path.exists(img_path):
-                        future = self.pool.add_task(
-                            self.work_img, task[1][0], url, img_path)
-                        if future:
-                            future.add_done_callback(self.callback_download)
+                future = self.pool.add_task(self.works[task[0]], *task[1])
+                if future:
+                    future.add_done_callback(self.callback_download)
         return is_add
 
+    def pop_works(self, count: int) -> list[tuple]:
+        """从队列取出任务，并准备好任务函数的参数
+
+        Args:
+            count (int): 最多取出的任务数
+
+        Returns:
+            list[tuple]: [(任务类型, 参数元组),...]，任务类型为comic、chapter、img
+        """
+        works = []
+        for _ in range(count):
+            task = self.pop_task_from_queue()
+            if not task:
+                break
+            if task[0] == 0:
+                url = ''
+                comic = query_comic(self.db, task[1])
+                if comic:
+                    url = comic.url
+                works.append(('comic', (task[1], url)))
+            elif task[0] == 1:
+                works.append(('chapter', (task[1],)))
+            elif task[0] == 2:
+                comicimg = query_comicimg(self.db, task[1][0], task[1][1])
+                if not comicimg:
+                    # 数据库没有这张图片，任务无法完成
+                    logger.warning(f'{task[1][0]} 没有第{task[1][1]}页的图片记录，删除任务')
+                    self.remove_task_from_queue(2, task[1][0], task[1][1])
+                    continue
+                url = query_comicimg_arr(self.db, comicimg, ComicImg.url)
+                url = url[0]
+                img_path = self.get_img_path(task[1][0], url)
+                if not self.file_index.exists(img_path):
+                    works.append(('img', (task[1][0], url, img_path, task[1][1])))
+                else:
+                    self.remove_task_from_queue(2, task[1][0], task[1][1])
+        return works
+
     def callback_download(self, future: Future):
         """回调函数，主页数据和页面数据线程callbakc
-        判断漫画缺少哪些数据就补齐那部分的数据
+        工作线程只把结果交给协调线程，由协调线程判断漫画缺少哪些数据
 
         Args:
             future (Future): 线程对象
         """
-        if future.done() and not future.cancelled():
-            result = future.result()
+        if future.done() and not future.cancelled() and not future.exception():
+            self.coordinator.put(future.result())
+        self.wakeup.set()
+
+    def handle_results(self, results: list[dict]):
+        """批量处理任务结果，同一部漫画的多个结果只检查一次
+
+        Args:
+            results (list[dict]): 线程函数的返回值列表
+        """
+        comicids = {}  # 需要检查的漫画，用dict保持顺序
+        chapterids = {}  # 需要查找所属漫画的章节
+        for result in results:
             if result['success']:
                 self.success_count += 1
                 if result['type'] == 0:
-                    self.check_comic(result['comicid'])
-                elif result['type'] == 1 or result['type'] == 2:
-                    chapter = query_chapter(self.db, result['comicid'])
-                    if chapter:
-                        comicid = query_chapter_comic(
-                            self.db, chapter, Comic.comicid)
-                        if comicid:
-                            self.check_comic(comicid[0])
-                        else:
-                            raise Exception(f"章节 {result['comicid']} 没有搜索到主页")
+                    comicids[result['comicid']] = None
+                elif result['type'] == 1:
+                    chapterids[result['comicid']] = None
+                elif result['type'] == 2:
+                    # 没有记录未完成图片的章节，需要完整检查一次
+                    if self.finish_img(result['comicid'], result['page']) is None:
+                        chapterids[result['comicid']] = None
             else:
-                if result['type'] == 0:
-                    self.remove_task_from_queue(0, result['comicid'])
-                    if result.get('is_del', False):
-                        comic = query_comic(self.db, result['comicid'])
-                        if comic:
-                            del_comic(self.db, comic)
-                if result['type'] == 1:
-                    self.remove_task_from_queue(1, result['comicid'])
-                if result['type'] == 2:
-                    # 重置任务，继续下载
-                    self.reset_task_from_queue(
-                        2, result['comicid'], result['page'])
+                self.handle_fail(result)
+
+        for chapterid in chapterids:
+            chapter = query_chapter(self.db, chapterid)
+            if chapter:
+                comicid = query_chapter_comic(
+                    self.db, chapter, Comic.comicid)
+                if comicid:
+                    comicids[comicid[0]] = None
+                else:
+                    logger.error(f"章节 {chapterid} 没有搜索到主页")
+
+        for comicid in comicids:
+            try:
+                self.check_comic(comicid)
+            except Exception as e:
+                logger.error(f'{comicid} check_comic出错. {e}')
+
+    def handle_fail(self, result: dict):
+        """处理失败的任务结果
+
+        Args:
+            result (dict): 线程函数的返回值
+        """
+        if result['type'] == 0:
+            self.task_queue.fail(0, result['comicid'])
+            if result.get('is_del', False):
+                comic = query_comic(self.db, result['comicid'])
+                if comic:
+                    del_comic(self.db, comic)
+        if result['type'] == 1:
+            self.task_queue.fail(1, result['comicid'])
+        if result['type'] == 2:
+            if result.get('permanent', False):
+                # 图片不存在，重新下载也不会成功
+                self.task_queue.fail(2, self._task_key(2, result['comicid'], result['page']))
+            else:
+                # 重置任务，继续下载，失败次数达到task_max_attempts时不再下载
+                if not self.reset_task_from_queue(2, result['comicid'], result['page']):
+                    logger.warning(f"{result['comicid']} 第{result['page']}页多次下载失败，不再下载")
 
     def check_comic(self, comicid: int) -> bool:
         comic = query_comic(self.db, comicid)
@@ -852,19 +1159,63 @@ class JMSpider:
                 for chapter in chapters:
                     is_done = self.check_chapter(chapter)
                     if is_done:
+                        static = query_chapter_arr(self.db, chapter, Chapter.static)
+                        if static[0] == 1:
+                            # 已完成的章节不再检查图片
+                            continue
                         is_done = self.check_img(chapter)
                         if is_done:
                             chapter = modify_chapter(
                                 self.db, chapter, static=1)
 
-                statics = query_comic_chapters(db, comic, Chapter.static)
-                statics = [static[0] == 1 for static in statics]
-                if all(statics):
-                    comic = modify_comic(self.db, comic, static=1)
-                    logger.info(f'{comicid} 完成，共{len(chapters)}话')
-                    return True
+                return self.check_comic_complete(comic)
         return False
 
+    def check_comic_complete(self, comic: Comic) -> bool:
+        """所有章节完成时，漫画状态设置为完成
+
+        Args:
+            comic (Comic): 漫画对象
+
+        Returns:
+            bool: 是否完成
+        """
+        statics = query_comic_chapters(db, comic, Chapter.static)
+        if statics and all(static[0] == 1 for static in statics):
+            comic = modify_comic(self.db, comic, static=1)
+            comicid = query_comic_arr(self.db, comic, Comic.comicid)
+            logger.info(f'{comicid[0]} 完成，共{len(statics)}话')
+            return True
+        return False
+
+    def finish_img(self, comicid: int, page: int) -> bool | None:
+        """图片下载完成，更新章节未完成的图片，章节的图片都完成时设置章节完成
+
+        Args:
+            comicid (int): 章节id
+            page (int): 图片页数
+
+        Returns:
+            bool | None: 章节是否完成，章节没有记录返回None
+        """
+        self.remove_task_from_queue(2, comicid, page)
+        with self.pending_lock:
+            pages = self.chapter_pending.get(comicid, None)
+            if pages is None:
+                return None
+            pages.discard(page)
+            if pages:
+                return False
+            del self.chapter_pending[comicid]
+
+        chapter = query_chapter(self.db, comicid)
+        if chapter:
+            chapter = modify_chapter(self.db, chapter, static=1)
+            comic = query_chapter_comic(self.db, chapter, Comic)
+            if comic:
+                self.check_comic_complete(comic)
+        return True
+
     def check_chapter(self, chapter: Chapter) -> bool:
         """判断是否添加页面任务
 
@@ -926,6 +1277,7 @@ class JMSpider:
         is_downloading = False
         is_add_task = False
         is_complet = True
+        pending = {}  # {page: img_path}
         for url, page in imgs:
             img_path = self.get_img_path(comicid, url)
             if not img_path:
@@ -934,17 +1286,33 @@ class JMSpider:
                 break
             # 判断是否在任务中，如果有本地文件，表示已经下载完，对任务删除
             if self.chenck_queue(2, comicid, page):
-                if os.path.exists(img_path):
+                if self.file_index.exists(img_path):
                     self.remove_task_from_queue(2, comicid, page)
                 else:
                     is_downloading = True
                     is_complet = False
+                    pending[page] = img_path
             # 如果不在任务，也没有本地文件，就添加任务
-            elif not os.path.exists(img_path):
+            elif not self.file_index.exists(img_path):
+                if self.task_queue.is_failed(2, self._task_key(2, comicid, page)):
+                    # 最近失败的图片，failed_task_days天内不再下载
+                    is_complet = False
+                    continue
                 if self.download_content.get("img", True):
                     self.add_task_to_queue(2, comicid, page)
                     is_add_task = True
                 is_complet = False
+                pending[page] = img_path
+
+        # 记录未完成的图片，之后每张图片完成时更新，不需要再检查整个章节
+        # 加锁后再判断一次文件，避免检查期间完成的图片被记录为未完成
+        with self.pending_lock:
+            pending = {page for page, img_path in pending.items()
+                       if not self.file_index.exists(img_path)}
+            if pending:
+                self.chapter_pending[comicid] = pending
+            else:
+                self.chapter_pending.pop(comicid, None)
 
         if not is_downloading and is_add_task:
             # 没有下载中任务且进行添加任务，表示第一次下载
@@ -963,11 +1331,12 @@ class JMSpider:
         Returns:
             bool: 文件数大于等于页数返回真
         """
-        comicid, title, page = query_chapter_arr(
-            self.db, chapter, Chapter.comicid, Chapter.title, Chapter.page)
-        comic_dir = self.get_comic_dir(comicid, title)
-        files = traversal_dir(comic_dir)
-        return len(files) >= page
+        comicid, page = query_chapter_arr(
+            self.db, chapter, Chapter.comicid, Chapter.page)
+        comic_dir = self.resolve_comic_dir(comicid)
+        if not comic_dir:
+            return False
+        return self.file_index.count(comic_dir) >= page
 
     def get_img_path(self, comicid: int, url: str) -> str:
         """根据漫画下载url生成漫画的图片路径
@@ -979,12 +1348,29 @@ class JMSpider:
         Returns:
             str: 图片路径
         """
+        comic_dir = self.resolve_comic_dir(comicid)
+        if not comic_dir:
+            return None
+        return JMDirHandle.get_img_path(url, comic_dir)
+
+    def resolve_comic_dir(self, comicid: int) -> str:
+        """获取章节的目录，结果按comicid缓存，章节标题修改后需要调用invalidate_comic_dir
+
+        Args:
+            comicid (int): 章节id
+
+        Returns:
+            str: 目录，出错返回None
+        """
+        comic_dir = self.comic_dirs.get(comicid, None)
+        if comic_dir:
+            return comic_dir
+
         chapter = query_chapter(self.db, comicid)
         if not chapter:
             return None
         title = query_chapter_arr(self.db, chapter, Chapter.title)
         title = title[0]
-        comic_dir = None
         try:
             comic_dir = self.get_comic_dir(comicid, title)
         except Exception as e:
@@ -995,9 +1381,23 @@ class JMSpider:
                 comicid = query_comic_arr(self.db, comic, Comic.comicid)
                 if comicid:
                     logger.info(f'{comicid[0]} 状态static设置为5')
-        if not comic_dir:
             return None
-        return JMDirHandle.get_img_path(url, comic_dir)
+        self.comic_dirs[comicid] = comic_dir
+        return comic_dir
+
+    def invalidate_comic_dir(self, comicid: int):
+        comic_dir = self.comic_dirs.pop(comicid, None)
+        if comic_dir:
+            self.file_index.invalidate(comic_dir)
+
+    def get_img_slices(self, comicid: int, url: str, img_path: str) -> int:
+        """获取图片的切片数，不需要还原的图片返回0
+        """
+        if comicid < self._transform_id:
+            return 0
+        if r'.gif' == url[-4:]:  # 图片是gif格式的，不用还原
+            return 0
+        return JMImgHandle.get_slices(str(comicid), os.path.basename(img_path).split('.')[0])
 
     def page_data_to_db(self, comicid: int, data: dict):
         """页面数据录入数据库
@@ -1008,126 +1408,93 @@ class JMSpider:
             comicid (int): 漫画id
             data (dict): 页面数据
         """
-        # 更新页面数据
-        chapter = query_chapter(self.db, int(comicid))
-        if not chapter:
-            chapter = add_chapter(
-                self.db, models.Chapter(comicid=int(comicid)))
-        chapter = modify_chapter(
-            self.db, chapter, page=data['curr_page'], title=data['title'])
-        chapterid = query_chapter_arr(self.db, chapter, Chapter.id)
-        chapterid = chapterid[0]
-
-        for url in data['urls']:
-            page = int(url_to_filename(url).split('.')[0])
-            img = query_comicimg_by_chapterid(self.db, chapterid, page)
-            if not img:
-                img = add_comicimg(self.db, ComicImg(url=url, page=page))
-            modify_chapter(self.db, chapter, imgs=img)
+        # 章节和图片一次写入
+        imgs = [(url, int(url_to_filename(url).split('.')[0]))
+                for url in data['urls']]
+        chapter_data_to_db(self.db, int(comicid),
+                           data['title'], data['curr_page'], imgs)
+        # 标题可能变化，目录需要重新生成
+        self.invalidate_comic_dir(int(comicid))
+
+    def _task_key(self, _type: int, comicid: int, page: int = 0):
+        return (comicid, page) if _type == 2 else comicid
 
     def chenck_queue(self, _type: int, comicid: int, page: int = 0) -> bool:
-        with self.queue_lock:
-            if _type == 0:
-                return comicid in self.task_queue['comic']
-            elif _type == 1:
-                return comicid in self.task_queue['chapter']
-            elif _type == 2:
-                return (comicid, page) in self.task_queue['img']
+        return self.task_queue.check(_type, self._task_key(_type, comicid, page))
 
     def add_task_to_queue(self, _type: int, comicid: int, page: int = 0):
-        with self.queue_lock:
-            if _type == 0:
-                if not comicid in self.task_queue['comic']:
-                    self.task_queue['comic'][comicid] = 0
-            elif _type == 1:
-                if not comicid in self.task_queue['chapter']:
-                    self.task_queue['chapter'][comicid] = 0
-            elif _type == 2:
-                if not (comicid, page) in self.task_queue['img']:
-                    self.task_queue['img'][(comicid, page)] = 0
+        self.task_queue.add(_type, self._task_key(_type, comicid, page))
 
     def remove_task_from_queue(self, _type: int, comicid: int, page: int = 0) -> bool:
-        with self.queue_lock:
-            if _type == 0:
-                if comicid in self.task_queue['comic']:
-                    del self.task_queue['comic'][comicid]
-                    return True
-            elif _type == 1:
-                if comicid in self.task_queue['chapter']:
-                    del self.task_queue['chapter'][comicid]
-                    return True
-            elif _type == 2:
-                if (comicid, page) in self.task_queue['img']:
-                    del self.task_queue['img'][(comicid, page)]
-                    return True
-        return False
+        return self.task_queue.remove(_type, self._task_key(_type, comicid, page))
 
     def pop_task_from_queue(self):
-        for i in self.download_priority:
-            res = self.priority_func[i[0]]()
-            if res:
-                return res
-        return None
-
-    def pop_comic_task_from_queue(self):
-        for k, v in self.task_queue['comic'].items():
-            if v == 0:
-                self.task_queue['comic'][k] = 1
-                return (0, k)
-        return None
-
-    def pop_chapter_task_from_queue(self):
-        for k, v in self.task_queue['chapter'].items():
-            if v == 0:
-                self.task_queue['chapter'][k] = 1
-                return (1, k)
-        return None
-
-    def pop_img_task_from_queue(self):
-        for k, v in self.task_queue['img'].items():
-            if v == 0:
-                self.task_queue['img'][k] = 1
-                return (2, k)
-        return None
-
-    def reset_task_from_queue(self, _type: int, comicid: int, page: int = 0):
-        with self.queue_lock:
-            if _type == 0:
-                if comicid in self.task_queue['comic']:
-                    self.task_queue['comic'][comicid] = 0
-            elif _type == 1:
-                if comicid in self.task_queue['chapter']:
-                    self.task_queue['chapter'][comicid] = 0
-            elif _type == 2:
-                if (comicid, page) in self.task_queue['img']:
-                    self.task_queue['img'][(comicid, page)] = 0
+        return self.task_queue.pop(self.download_priority)
+
+    def reset_task_from_queue(self, _type: int, comicid: int, page: int = 0) -> bool:
+        return self.task_queue.reset(_type, self._task_key(_type, comicid, page))
 
     def is_empty_queue(self) -> bool:
-        with self.queue_lock:
-            return not any((self.task_queue['comic'], self.task_queue['chapter'], self.task_queue['img']))
+        return self.task_queue.empty()
 
     def queue_count(self) -> int:
-        with self.queue_lock:
-            return len(self.task_queue['comic']) + len(self.task_queue['chapter']) + len(self.task_queue['img'])
-        
-    def check_1px_img(self):
-        """检查1像素图片
+        return self.task_queue.count()
 
+    def load_task_queue(self):
+        """从数据库加载上次未完成的任务，并删除很久以前失败的任务
+        """
+        count = del_old_tasks(self.db, TaskQueue.FAILED, self.cfg.get('failed_task_days', 7))
+        if count:
+            logger.info(f'删除失败的任务数:{count}')
+        statics = [TaskQueue.PENDING, TaskQueue.RUNNING]
+        tasks = query_tasks(self.db, statics)
+        self.task_queue.load([(_type, self._task_key(_type, comicid, page), attempts)
+                              for _type, comicid, page, attempts in tasks])
+        # 最近失败的任务，检查漫画时不再添加，超过failed_task_days天的已经删除
+        failed = query_tasks(self.db, [TaskQueue.FAILED])
+        self.task_queue.load_failed([(_type, self._task_key(_type, comicid, page))
+                                     for _type, comicid, page, _ in failed])
+        self.walked_comics = query_task_comicids(self.db, statics)
+        logger.info(f'加载未完成的任务数:{len(tasks)}，涉及漫画数:{len(self.walked_comics)}')
+
+    def save_task_queue(self):
+        """把任务队列的变化批量写入数据库
         """
-        res_list= []
-        dir = self.cfg.get('save_dir', '')
-        if os.path.isdir(dir):
-            for sub_dir in os.listdir(dir):
-                if os.path.isdir(os.path.join(dir,sub_dir)):
-                    for file in os.listdir(os.path.join(dir,sub_dir)):
-                        if os.path.isfile(os.path.join(dir,sub_dir,file)):
-                            size = os.path.getsize(os.path.join(dir,sub_dir,file))
-                            if size < 1024:
-                                res_list.append(os.path.join(dir,sub_dir))
-                                break
+        changes = self.task_queue.take_changes()
+        if not changes:
+            return
+        tasks = []
+        del_tasks = []
+        for (_type, key), value in changes.items():
+            comicid, page = key if _type == 2 else (key, 0)
+            if value is None:
+                del_tasks.append({'type': _type, 'comicid': comicid, 'page': page})
+            else:
+                tasks.append({'type': _type, 'comicid': comicid, 'page': page,
+                              'static': value[0], 'attempts': value[1]})
+        save_tasks(self.db, tasks, del_tasks)
         
-        if res_list:
-            logger.info(f'{res_list}')
+    def check_library(self, requeue: bool = True) -> dict:
+        """检查漫画库，找出缺失、1像素和不完整的图片，报告保存到data目录
+
+        Args:
+            requeue (bool, optional): 删除有问题的图片并添加下载任务. Defaults to True.
+
+        Returns:
+            dict: 检查报告
+        """
+        scanner = JMLibraryScanner(self.db, self.dir_index,
+                                   max_workers=self.cfg.get('scan_thread_max', 16),
+                                   logger=logger)
+        report = scanner.scan()
+        report_file = os.path.join(json_dir, f'scan_report_{date.today()}.json')
+        scanner.save_report(report, report_file)
+        logger.info(f'检查报告保存到 {report_file}')
+        if requeue:
+            scanner.requeue(report)
+            # 删除了图片，文件缓存需要重新扫描
+            self.file_index.invalidate()
+        return report
 
 
 if __name__ == "__main__":
@@ -1,10 +1,18 @@
 import hashlib
+import json
 import os
 import re
-from zipfile import ZipFile, ZIP_DEFLATED
+import time
+from io import BytesIO
+from functools import lru_cache
+from threading import Lock
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
 
 import platform
-from PIL import Image
+import numpy as np
+from PIL import Image, UnidentifiedImageError
 from tqdm import tqdm
 
 from tools import (traversal_dir,
@@ -16,6 +24,10 @@ from tools import (traversal_dir,
 
 OS_NAME = platform.system()
 
+# 目录名 "comicid-标题" 和图片名 "页数.jpg"
+_DIR_COMICID_RE = re.compile(r'(\d+)-')
+_JPG_PAGE_RE = re.compile(r'(\d+).jpg')
+
 class JMImgHandle:
 
     @staticmethod
@@ -41,38 +53,70 @@ class JMImgHandle:
         return (n+1)*2 if 0 <= n <= 9 else 10
 
     @staticmethod
-    def img_slice_restore(img_file: str, out_file: str, slices: int) -> None:
-        """根据图片切片数进行还原
-        """
+    @lru_cache(maxsize=128)
+    def get_row_index(height: int, slices: int) -> np.ndarray:
+        """还原后每一行对应原图的行号
 
-        img = Image.open(img_file)
+        原图从下往上按切片高度切开，最底部的切片包含除不尽的行，
+        还原时切片顺序反转，行的顺序不变
+        """
+        slice_h = height // slices
+        slice_other = height % slices
+        index = [np.arange(height - slice_h - slice_other, height)]
+        for i in range(1, slices):
+            in_img_y = height - slice_h * (i + 1) - slice_other
+            index.append(np.arange(in_img_y, in_img_y + slice_h))
+        return np.concatenate(index)
 
-        # 获取图片的宽度和高度
-        width, height = img.size
+    @staticmethod
+    def img_restore(img: Image.Image, slices: int) -> Image.Image:
+        """还原内存中的图片，一次按行索引复制像素，不进行裁剪和粘贴
+        """
+        if slices <= 1:
+            return img
+        arr = np.asarray(img)
+        index = JMImgHandle.get_row_index(arr.shape[0], slices)
+        return Image.fromarray(arr[index])
 
-        # 创建一个空白图片，大小与原图一致，背景色为白色
-        new_img = Image.new('RGB', (width, height), 'white')
+    @staticmethod
+    def save_img(content: bytes, out_file: str, slices: int = 0) -> float:
+        """下载的图片数据解码、还原、转jpg，一次写入
 
-        # 切片高度
-        slice_h = int(height / slices)
-        slice_other = height % slices
-        for i in range(slices):
-            # 旧图起始y坐标
-            in_img_y = height - slice_h * (i + 1) - slice_other
+        先写入临时文件再重命名，写入一半的文件不会被当作已下载
 
-            # 旧图结束y坐标
-            # 新图起始y坐标
-            if i == 0:
-                in_img_endy = height
-                out_img_y = 0
-            else:
-                in_img_endy = in_img_y + slice_h
-                out_img_y = slice_h * i + slice_other
+        Args:
+            content (bytes): 图片数据
+            out_file (str): 保存路径
+            slices (int, optional): 切片数，0表示不需要还原. Defaults to 0.
 
-            # crop() 4个参数分别起始坐标和结束坐标
-            old_img = img.crop((0, in_img_y, width, in_img_endy))
-            new_img.paste(old_img, (0, out_img_y))
+        Returns:
+            float: 处理耗时(秒)，在进程池中调用时不包括排队时间
+        """
+        start = time.perf_counter()
+        try:
+            with Image.open(BytesIO(content)) as img:
+                new_img = img.convert('RGB')
+            if slices:
+                new_img = JMImgHandle.img_restore(new_img, slices)
+        except UnidentifiedImageError:
+            # 请求成功，但是数据有问题，就创建一个像素的图片
+            new_img = Image.new('RGB', (1, 1), color=(255, 255, 255))
+
+        tmp_file = f'{out_file}.tmp'
+        try:
+            new_img.save(tmp_file, format='JPEG')
+            os.replace(tmp_file, out_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+        return time.perf_counter() - start
 
+    @staticmethod
+    def img_slice_restore(img_file: str, out_file: str, slices: int) -> None:
+        """根据图片切片数进行还原
+        """
+        with Image.open(img_file) as img:
+            new_img = JMImgHandle.img_restore(img.convert('RGB'), slices)
         new_img.save(out_file)
 
     def restore_img(comicid: str, pageid: str, img_file: str, out_file: str = None):
@@ -107,6 +151,9 @@ class JMDirHandle:
     @staticmethod
     def get_comics_dirs(comicids: list, dirs: list) -> list:
         """获取comicids的目录，当comicid存在dirs中，就会被返回
+        找到的comicid会从comicids中移除，剩下的是没有找到的
+
+        需要多次查找时使用JMComicDirIndex
 
         Args:
             comicids (list): 漫画id字符串列表
@@ -118,31 +165,22 @@ class JMDirHandle:
         ret_list = []
         if not (comicids and dirs):
             return ret_list
+        if isinstance(dirs, str):
+            dirs = [dirs]
+        wanted = set(comicids)
         for dir in dirs:
-            for file in os.listdir(dir):
-                if os.path.isdir(os.path.join(dir, file)):
-                    id = file.split('-')[0]
-                    if id in comicids:
-                        ret_list.append(os.path.abspath(
-                            os.path.join(dir, file)))
-                        comicids.remove(id)
+            for id, path in JMComicDirIndex.scan_root(dir).items():
+                if id in wanted:
+                    ret_list.append(os.path.abspath(path))
+                    wanted.discard(id)
+        comicids[:] = [id for id in comicids if id in wanted]
         return ret_list
 
     @staticmethod
     def get_dir_comicid(dir: str) -> list:
         """获取目录下所有的comicid
         """
-        ids = []
-        if os.path.exists(dir):
-            for name in os.listdir(dir):
-                try:
-                    if os.path.isdir(os.path.join(dir, name)):
-                        s = name.split('-')
-                        if len(s) > 1:
-                            ids.append(s[0])
-                except:
-                    pass
-        return ids
+        return list(JMComicDirIndex.scan_root(dir))
 
     @staticmethod
     def get_dirs_comicid(dirs: list) -> list:
@@ -164,8 +202,7 @@ class JMDirHandle:
             str: comicid
         """
         name = os.path.basename(dir)
-        comp = re.compile('(\d+)-')
-        res = re.findall(comp, name)
+        res = _DIR_COMICID_RE.findall(name)
         if res:
             return res[0]
         return None
@@ -181,8 +218,7 @@ class JMDirHandle:
             int: 页数
         """
         name = os.path.basename(jpg_file)
-        comp = re.compile('(\d+).jpg')
-        res = re.findall(comp, name)
+        res = _JPG_PAGE_RE.findall(name)
         if res:
             return int(res[0])
         return None
@@ -283,46 +319,294 @@ class JMDirHandle:
 
     #     shutil.rmtree(outfile_dir)
 
+    # 写入压缩包时每次读取的大小
+    ZIP_CHUNK_SIZE = 1 << 20
+
+    @staticmethod
+    def _zip_write(myzip: ZipFile, path: str, arcname: str, compression: int):
+        """把文件按块写入压缩包，不把整个文件读入内存
+        """
+        zinfo = ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = compression
+        with open(path, 'rb') as src, myzip.open(zinfo, 'w') as dst:
+            shutil.copyfileobj(src, dst, JMDirHandle.ZIP_CHUNK_SIZE)
+
     @staticmethod
-    def zip_dir(dirs: list, out_file: str):
-        """打包漫画
+    def _comic_files(dir: str) -> list[tuple[str, str]]:
+        """漫画目录下的文件，按文件名排序
+
+        Returns:
+            list[tuple[str, str]]: [(文件名, 路径),...]
+        """
+        with os.scandir(dir) as it:
+            return sorted((entry.name, entry.path) for entry in it if entry.is_file())
+
+    @staticmethod
+    def zip_dir(dirs: list, out_file: str, compression: int = ZIP_STORED):
+        """把多部漫画打包到一个压缩包，每部漫画一个目录
+
+        Args:
+            dirs (list): 漫画目录
+            out_file (str): 压缩包
+            compression (int, optional): 压缩方式，jpg已经是压缩过的，默认只存储. Defaults to ZIP_STORED.
         """
         if not dirs:
             return
 
-        with ZipFile(out_file, 'w', ZIP_DEFLATED) as myzip:
+        with ZipFile(out_file, 'w', compression) as myzip:
             for dir in dirs:
                 if not os.path.isdir(dir):
                     continue
                 write_dir = os.path.basename(dir)
                 myzip.mkdir(write_dir)
-                for file in os.listdir(dir):
-                    path = os.path.join(dir, file)
-                    if os.path.isfile(path):
-                        myzip.write(path, os.path.join(write_dir, file))
+                for file, path in JMDirHandle._comic_files(dir):
+                    JMDirHandle._zip_write(myzip, path, '/'.join((write_dir, file)), compression)
+
+    @staticmethod
+    def zip_comic_dir(dir: str, out_file: str, compression: int = ZIP_STORED) -> str:
+        """把一部漫画打包成一个压缩包，图片放在压缩包根目录，可以直接作为cbz使用
+
+        先写入.tmp文件，完成后再替换，中断时不会留下不完整的压缩包
+
+        Args:
+            dir (str): 漫画目录
+            out_file (str): 压缩包
+            compression (int, optional): 压缩方式. Defaults to ZIP_STORED.
+
+        Returns:
+            str: 压缩包
+        """
+        tmp_file = f'{out_file}.tmp'
+        try:
+            with ZipFile(tmp_file, 'w', compression) as myzip:
+                for file, path in JMDirHandle._comic_files(dir):
+                    JMDirHandle._zip_write(myzip, path, file, compression)
+            os.replace(tmp_file, out_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+        return out_file
+
+    @staticmethod
+    def zip_dirs(dirs: list, out_dir: str, ext: str = '.zip', compression: int = ZIP_STORED,
+                 max_workers: int = 0) -> list:
+        """每部漫画打包成单独的压缩包，多个漫画同时打包
+
+        压缩和crc计算都在zlib中进行，会释放GIL，所以用线程就可以利用多个核心
+
+        Args:
+            dirs (list): 漫画目录
+            out_dir (str): 压缩包保存目录
+            ext (str, optional): 压缩包扩展名，.zip或者.cbz. Defaults to '.zip'.
+            compression (int, optional): 压缩方式. Defaults to ZIP_STORED.
+            max_workers (int, optional): 同时打包的数量，0表示使用CPU核心数. Defaults to 0.
+
+        Returns:
+            list: 生成的压缩包
+        """
+        dirs = [dir for dir in dirs if os.path.isdir(dir)]
+        if not dirs:
+            return []
+        os.makedirs(out_dir, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            futures = [pool.submit(JMDirHandle.zip_comic_dir, dir,
+                                   os.path.join(out_dir, os.path.basename(dir) + ext), compression)
+                       for dir in dirs]
+            return [future.result() for future in tqdm(futures)]
+
+
+class JMFileIndex:
+    """漫画目录的文件列表缓存，线程安全
+
+    每个目录第一次查询时执行一次os.scandir，之后通过add、discard更新，
+    不需要每张图片都去访问文件系统，save_dir在网络磁盘上时效果明显
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._dirs: dict[str, set[str]] = {}
+
+    @staticmethod
+    def _scan(dir: str) -> set[str]:
+        files = set()
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    # 跳过写入中的临时文件
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        files.add(entry.name)
+        except FileNotFoundError:
+            pass
+        return files
+
+    def _files(self, dir: str) -> set[str]:
+        files = self._dirs.get(dir, None)
+        if files is None:
+            # 扫描目录不加锁，避免阻塞其他目录的查询
+            files = self._scan(dir)
+            with self._lock:
+                files = self._dirs.setdefault(dir, files)
+        return files
+
+    def exists(self, path: str) -> bool:
+        dir, name = os.path.split(path)
+        return name in self._files(dir)
+
+    def count(self, dir: str) -> int:
+        return len(self._files(dir))
+
+    def add(self, path: str):
+        dir, name = os.path.split(path)
+        files = self._files(dir)
+        with self._lock:
+            files.add(name)
+
+    def discard(self, path: str):
+        dir, name = os.path.split(path)
+        files = self._files(dir)
+        with self._lock:
+            files.discard(name)
+
+    def invalidate(self, dir: str = None):
+        """清除缓存，下次查询时重新扫描目录
+
+        Args:
+            dir (str, optional): 需要清除的目录，None表示清除所有. Defaults to None.
+        """
+        with self._lock:
+            if dir is None:
+                self._dirs.clear()
+            else:
+                self._dirs.pop(dir, None)
+
+
+class JMComicDirIndex:
+    """漫画目录索引 {comicid: 目录}，线程安全
+
+    用os.scandir扫描各个根目录下 comicid-标题 格式的子目录，索引保存到json文件。
+    根目录下增删、重命名子目录会改变根目录的修改时间，
+    所以refresh只重新扫描修改时间变化的根目录。
+    同一个comicid在多个根目录中存在时，使用排在前面的根目录。
+    """
+
+    def __init__(self, roots: list[str], index_file: str = None) -> None:
+        """
+        Args:
+            roots (list[str]): 保存漫画的根目录
+            index_file (str, optional): 索引文件，None表示不保存. Defaults to None.
+        """
+        self.roots = [os.path.abspath(root) for root in roots if root]
+        self.index_file = index_file
+        self._lock = Lock()
+        # {根目录: {'mtime': 修改时间, 'dirs': {comicid: 目录名}}}
+        self._roots: dict[str, dict] = {}
+        self._index: dict[str, str] = {}
+        self._load()
 
     @staticmethod
-    def simple_check_comic(comic_dir: str) -> bool:
-        """简单检漫画文件是否完整
-        漫画图片是以00001.jpg格式命名，通过找出最大文件名，
-        检查文件数量是否等于文件名来判断漫画是否完整。
+    def scan_root(root: str) -> dict[str, str]:
+        """扫描根目录下的漫画目录
+
+        Returns:
+            dict[str, str]: {comicid: 目录}
+        """
+        ret = {}
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if '-' in entry.name and entry.is_dir():
+                        ret.setdefault(entry.name.split('-')[0], entry.path)
+        except FileNotFoundError:
+            pass
+        return ret
+
+    @staticmethod
+    def _mtime(root: str) -> int | None:
+        try:
+            return os.stat(root).st_mtime_ns
+        except FileNotFoundError:
+            return None
 
-        存在问题：如果缺失的是漫画未尾文件就没办法检测出来。
+    def _load(self):
+        if not (self.index_file and os.path.isfile(self.index_file)):
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._roots = {root: data[root] for root in self.roots if root in data}
+        self._rebuild()
+
+    def _rebuild(self):
+        index = {}
+        for root in reversed(self.roots):
+            data = self._roots.get(root, None)
+            if data:
+                index.update({id: os.path.join(root, name) for id, name in data['dirs'].items()})
+        self._index = index
+
+    def save(self):
+        if not self.index_file:
+            return
+        with self._lock:
+            data = dict(self._roots)
+        tmp_file = f'{self.index_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_file, self.index_file)
+
+    def refresh(self, force: bool = False) -> int:
+        """重新扫描修改时间变化的根目录，有变化时保存索引
 
         Args:
-            comic_dir (str): 漫画目录
+            force (bool, optional): 扫描所有根目录. Defaults to False.
 
         Returns:
-            bool: 不缺失返回True
+            int: 扫描的根目录数
         """
-        files = traversal_dir(comic_dir)
-        if files:
-            files.sort()  # 字符串小到大
-            # print(*files,sep='\n')
-            max = JMDirHandle.jpg_to_page(files[-1])
-            if max > len(files):
-                return False
-        return True
+        scanned = 0
+        for root in self.roots:
+            mtime = self._mtime(root)
+            data = self._roots.get(root, None)
+            if not force and data and data['mtime'] == mtime:
+                continue
+            dirs = {id: os.path.basename(path) for id, path in self.scan_root(root).items()}
+            with self._lock:
+                self._roots[root] = {'mtime': mtime, 'dirs': dirs}
+            scanned += 1
+        if scanned:
+            with self._lock:
+                self._rebuild()
+            self.save()
+        return scanned
+
+    def get(self, comicid: str | int) -> str | None:
+        return self._index.get(str(comicid), None)
+
+    def get_many(self, comicids: list) -> tuple[list[str], list[str]]:
+        """查找多个comicid的目录
+
+        Returns:
+            tuple[list[str], list[str]]: (找到的目录, 没有找到的comicid)
+        """
+        dirs, missing = [], []
+        for comicid in comicids:
+            dir = self._index.get(str(comicid), None)
+            if dir:
+                dirs.append(dir)
+            else:
+                missing.append(str(comicid))
+        return dirs, missing
+
+    def items(self) -> list[tuple[str, str]]:
+        """所有漫画 [(comicid, 目录),...]
+        """
+        return list(self._index.items())
+
+    def __len__(self) -> int:
+        return len(self._index)
 
 
 def extract_and_combine_numbers(input_strings: str):
@@ -358,7 +642,5 @@ def log_filter_fail_id(log_file: str):
 
 if __name__ == "__main__":
     pass
-    dir = r'D:\禁漫天堂\data\禁漫天堂\未整理\7347-母さんじゃなきゃダメなんだっ 2'
-    print(JMDirHandle.simple_check_comic(dir))
     # jpg = r'D:\禁漫天堂\data\禁漫天堂\未整理\16576-[LINDA] W-HIP-asdfasdf\00001.jpg'
     # print(JMDirHandle.jpg_to_page(jpg))
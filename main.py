@@ -1,6 +1,11 @@
-from jmspider import JMSpider
-
 if __name__ == '__main__':
+    # 图片进程池使用spawn，子进程会重新导入main模块，
+    # 在这里导入，子进程只加载jmtools，不会连接数据库、加载浏览器和配置
+    from jmspider import JMSpider
+
     jms = JMSpider()
     jms.check_search()
-    jms.download_comic_3()
\ No newline at end of file
+    if jms.cfg.get('download_mode', 'thread') == 'async':
+        jms.download_comic_async()
+    else:
+        jms.download_comic_3()
\ No newline at end of file
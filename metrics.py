@@ -0,0 +1,245 @@
+import time
+import bisect
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter:
+    """只增加的计数，线程安全
+
+    有callback时从回调读取计数，用于其他地方已经在统计的值，回调返回 {标签值元组: 值}
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple = (), callback=None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+        self._lock = Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def _items(self) -> list[tuple[tuple, float]]:
+        if self.callback:
+            try:
+                return list(self.callback().items())
+            except Exception:
+                return []
+        with self._lock:
+            return list(self._values.items())
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        """[(名称后缀, 标签值, 值),...]
+        """
+        return [('', k, v) for k, v in self._items()]
+
+    def snapshot(self):
+        return {'/'.join(map(str, k)) or 'all': v for k, v in self._items()}
+
+
+class Gauge:
+    """读取时通过回调获取当前值
+
+    回调返回 {标签值元组: 值}
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple = (), callback=None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        if not self.callback:
+            return []
+        try:
+            return [('', k, v) for k, v in self.callback().items()]
+        except Exception:
+            return []
+
+    def snapshot(self):
+        return {'/'.join(map(str, k)) or 'all': v for _, k, v in self.samples()}
+
+
+class Histogram:
+    """分布统计，线程安全
+
+    buckets是每个区间的上限，输出时按Prometheus格式累加
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+        # {标签值: [每个区间的数量(最后一个是+Inf), 总和, 数量]}
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(label_values, None)
+            if data is None:
+                data = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[label_values] = data
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def time(self, *label_values):
+        """计时，用法: with histogram.time(标签值): ...
+        """
+        return _Timer(self, label_values)
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        ret = []
+        with self._lock:
+            for k, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    ret.append(('_bucket', k + (le,), cumulative))
+                ret.append(('_sum', k, total))
+                ret.append(('_count', k, count))
+        return ret
+
+    def snapshot(self):
+        with self._lock:
+            return {'/'.join(map(str, k)) or 'all': {'count': count, 'avg': round(total / count, 4) if count else 0}
+                    for k, (_, total, count) in self._values.items()}
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: tuple) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class MetricsRegistry:
+    """管理所有统计，输出Prometheus文本格式或者用于日志的dict
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = (), callback=None) -> Counter:
+        return self.register(Counter(name, help, labels, callback))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, labels: tuple = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, callback))
+
+    def get(self, name: str):
+        return self._metrics.get(name, None)
+
+    @staticmethod
+    def _format_labels(names: tuple, values: tuple) -> str:
+        if not values:
+            return ''
+        pairs = ','.join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                         for n, v in zip(names, values))
+        return '{' + pairs + '}'
+
+    def render(self) -> str:
+        """Prometheus文本格式
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            _type = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metric)]
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {_type}')
+            names = metric.labels + (('le',) if isinstance(metric, Histogram) else ())
+            for suffix, label_values, value in metric.samples():
+                label_names = names if suffix == '_bucket' else metric.labels
+                lines.append(f'{metric.name}{suffix}{self._format_labels(label_names, label_values)} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def snapshot(self) -> dict:
+        """所有统计的当前值，用于输出日志
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+class MetricsServer:
+    """在后台线程提供 http://host:port/metrics
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = '127.0.0.1') -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # 不输出每次请求的日志
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# 全局统计
+registry = MetricsRegistry()
+DOWNLOAD_BYTES = registry.counter('jm_download_bytes_total', '下载的字节数', ('type',))
+REQUESTS = registry.counter('jm_requests_total', '请求数', ('type', 'status'))
+REQUEST_SECONDS = registry.histogram('jm_request_seconds', '请求耗时', ('type',))
+DB_LOCK_WAIT_SECONDS = registry.histogram('jm_db_lock_wait_seconds', '等待数据库写锁的时间', (),
+                                          (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+IMG_SAVE_SECONDS = registry.histogram('jm_img_save_seconds', '图片还原和保存的耗时，在进程池中计时', ())
+IMG_QUEUE_SECONDS = registry.histogram('jm_img_queue_seconds', '图片等待进程池的时间', ())
+
+
+if __name__ == "__main__":
+    # 测试记录统计的开销
+    number = 100000
+    start = time.perf_counter()
+    for i in range(number):
+        REQUEST_SECONDS.observe(i % 100 / 100, 'img')
+    print(f'observe: {(time.perf_counter() - start) / number * 1e6:.2f}us')
+    start = time.perf_counter()
+    for i in range(number):
+        DOWNLOAD_BYTES.inc(1024, 'img')
+    print(f'inc: {(time.perf_counter() - start) / number * 1e6:.2f}us')
+    print(registry.render())
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """令牌桶限速，线程和协程都可以使用
+
+    速率按AIMD调整：请求成功时速率加increase，被限流或服务器出错时速率乘decrease
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: float = None,
+                 min_rate: float = 0.2,
+                 max_rate: float = None,
+                 increase: float = 0.1,
+                 decrease: float = 0.5,
+                 ) -> None:
+        """
+        Args:
+            rate (float): 初始速率，每秒请求数
+            burst (float, optional): 桶容量，允许的突发请求数. Defaults to rate.
+            min_rate (float, optional): 最小速率. Defaults to 0.2.
+            max_rate (float, optional): 最大速率. Defaults to rate的4倍.
+            increase (float, optional): 成功时增加的速率. Defaults to 0.1.
+            decrease (float, optional): 失败时速率的倍数. Defaults to 0.5.
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def _reserve(self) -> float:
+        """预定一个令牌，返回需要等待的秒数
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class RateLimiter:
+    """按host和请求类型限速
+
+    请求类型: search 搜索页, photo 漫画页, album 主页, img 图片
+    """
+
+    DEFAULT_RATE = {'search': 2, 'photo': 5, 'album': 5, 'img': 20}
+
+    def __init__(self, rates: dict = None) -> None:
+        self.rates = dict(self.DEFAULT_RATE)
+        if rates:
+            self.rates.update(rates)
+        self._lock = Lock()
+        self._buckets: dict[tuple, TokenBucket] = {}
+
+    def get_bucket(self, url: str, _type: str) -> TokenBucket:
+        key = (urlparse(url).netloc, _type)
+        with self._lock:
+            bucket = self._buckets.get(key, None)
+            if not bucket:
+                bucket = TokenBucket(self.rates.get(_type, 5))
+                self._buckets[key] = bucket
+            return bucket
+
+    def set_rates(self, rates: dict):
+        """修改初始速率，已创建的令牌桶会被清除
+        """
+        with self._lock:
+            self.rates.update(rates)
+            self._buckets.clear()
+
+    @staticmethod
+    def is_throttle(status_code: int) -> bool:
+        """状态码是否表示请求过快或服务器压力过大
+        """
+        return status_code == 429 or status_code >= 500
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class TaskQueue:
+    """下载任务队列，线程安全
+
+    每种任务类型有一个等待队列和一个下载中集合，
+    添加、取出、重置、删除都是O(1)操作。
+
+    任务类型: 0 comic, 1 chapter, 2 img
+    任务key: comic和chapter是comicid，img是(comicid, page)
+
+    队列的变化会记录下来，通过take_changes取出后批量写入数据库，
+    重启时用load加载，不需要重新检查所有漫画。
+
+    失败的任务不会再被add添加，重置次数达到max_attempts的任务也作为失败处理，
+    重启时用load_failed加载最近失败的任务。
+    """
+
+    TYPES = {0: 'comic', 1: 'chapter', 2: 'img'}
+
+    # 任务状态
+    PENDING = 0
+    RUNNING = 1
+    FAILED = 2
+
+    def __init__(self, max_attempts: int = 5) -> None:
+        """
+        Args:
+            max_attempts (int, optional): 最多下载次数，0表示不限制. Defaults to 5.
+        """
+        self.max_attempts = max_attempts
+        self._lock = Lock()
+        self._pending: dict[int, OrderedDict] = {t: OrderedDict() for t in self.TYPES}
+        self._running: dict[int, set] = {t: set() for t in self.TYPES}
+        self._attempts: dict[int, dict] = {t: {} for t in self.TYPES}
+        self._failed: dict[int, set] = {t: set() for t in self.TYPES}
+        # 未保存的变化 {(任务类型, key): (状态, 失败次数)}，值为None表示删除
+        self._changes: dict[tuple, tuple | None] = {}
+
+    def check(self, _type: int, key) -> bool:
+        """任务是否在队列中，包括下载中的任务
+        """
+        with self._lock:
+            return key in self._pending[_type] or key in self._running[_type]
+
+    def add(self, _type: int, key) -> bool:
+        with self._lock:
+            if key in self._pending[_type] or key in self._running[_type] or key in self._failed[_type]:
+                return False
+            self._pending[_type][key] = None
+            self._changes[(_type, key)] = (self.PENDING, self._attempts[_type].get(key, 0))
+            return True
+
+    def remove(self, _type: int, key) -> bool:
+        with self._lock:
+            if key in self._running[_type]:
+                self._running[_type].discard(key)
+            elif key in self._pending[_type]:
+                del self._pending[_type][key]
+            else:
+                return False
+            self._attempts[_type].pop(key, None)
+            self._changes[(_type, key)] = None
+            return True
+
+    def fail(self, _type: int, key) -> bool:
+        """任务失败，从队列中移除，保存为失败状态
+        """
+        with self._lock:
+            if key in self._running[_type]:
+                self._running[_type].discard(key)
+            elif key in self._pending[_type]:
+                del self._pending[_type][key]
+            else:
+                return False
+            attempts = self._attempts[_type].pop(key, 0) + 1
+            self._failed[_type].add(key)
+            self._changes[(_type, key)] = (self.FAILED, attempts)
+            return True
+
+    def is_failed(self, _type: int, key) -> bool:
+        with self._lock:
+            return key in self._failed[_type]
+
+    def pop(self, priority: list[int]):
+        """按优先级取出一个等待中的任务，任务转为下载中
+
+        Args:
+            priority (list[int]): 任务类型列表，排在前面的先取
+
+        Returns:
+            tuple | None: (任务类型, key)
+        """
+        with self._lock:
+            for _type in priority:
+                pending = self._pending[_type]
+                if pending:
+                    key, _ = pending.popitem(last=False)
+                    self._running[_type].add(key)
+                    self._changes[(_type, key)] = (self.RUNNING, self._attempts[_type].get(key, 0))
+                    return (_type, key)
+        return None
+
+    def reset(self, _type: int, key) -> bool:
+        """下载中的任务重新放回等待队列末尾，失败次数加1，
+        失败次数达到max_attempts时作为失败任务移除
+
+        Returns:
+            bool: 是否放回等待队列
+        """
+        with self._lock:
+            if key in self._running[_type]:
+                self._running[_type].discard(key)
+                attempts = self._attempts[_type].get(key, 0) + 1
+                if self.max_attempts and attempts >= self.max_attempts:
+                    self._attempts[_type].pop(key, None)
+                    self._failed[_type].add(key)
+                    self._changes[(_type, key)] = (self.FAILED, attempts)
+                    return False
+                self._pending[_type][key] = None
+                self._attempts[_type][key] = attempts
+                self._changes[(_type, key)] = (self.PENDING, attempts)
+                return True
+        return False
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not any(self._pending[t] or self._running[t] for t in self.TYPES)
+
+    def count(self, _type: int = None) -> int:
+        with self._lock:
+            types = self.TYPES if _type is None else (_type,)
+            return sum(len(self._pending[t]) + len(self._running[t]) for t in types)
+
+    def load(self, tasks: list[tuple]):
+        """加载保存的任务，下载中的任务会作为等待任务加载
+
+        Args:
+            tasks (list[tuple]): [(任务类型, key, 失败次数),...]
+        """
+        with self._lock:
+            for _type, key, attempts in tasks:
+                if key in self._pending[_type] or key in self._running[_type]:
+                    continue
+                self._pending[_type][key] = None
+                if attempts:
+                    self._attempts[_type][key] = attempts
+
+    def load_failed(self, tasks: list[tuple]):
+        """加载失败的任务，这些任务不会再被添加
+
+        Args:
+            tasks (list[tuple]): [(任务类型, key),...]
+        """
+        with self._lock:
+            for _type, key in tasks:
+                self._failed[_type].add(key)
+
+    def take_changes(self) -> dict[tuple, tuple | None]:
+        """取出未保存的变化，并清空记录
+        """
+        with self._lock:
+            changes = self._changes
+            self._changes = {}
+        return changes
+
+    def __repr__(self) -> str:
+        with self._lock:
+            data = {}
+            for t, name in self.TYPES.items():
+                data[name] = {key: 0 for key in self._pending[t]}
+                data[name].update({key: 1 for key in self._running[t]})
+        return repr(data)
+
+
+if __name__ == "__main__":
+    # 测试取出任务的耗时是否随队列长度增长
+    import time
+
+    for size in (1000, 10000, 100000):
+        queue = TaskQueue()
+        for i in range(size):
+            queue.add(2, (i // 300, i % 300))
+        start = time.perf_counter()
+        for _ in range(1000):
+            task = queue.pop([0, 1, 2])
+            queue.reset(*task)
+        cost = (time.perf_counter() - start) / 1000 * 1e6
+        print(f'队列长度: {size:>6}, 每次pop+reset耗时: {cost:.2f}us')
@@ -1,12 +1,17 @@
-from concurrent.futures import ThreadPoolExecutor, wait, Future, as_completed
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock, BoundedSemaphore, Thread
+from queue import Queue, Empty
+import multiprocessing
 import logging
+import signal
+import os
 
 
 class MyTheadingPool():
     def __init__(self, max=5) -> None:
         self.pool = ThreadPoolExecutor(max_workers=max)
-        self.futures:list[Future] = []
+        self.futures:set[Future] = set()
         self._wroking = True
         self._lock = Lock()
 
@@ -14,7 +19,7 @@ class MyTheadingPool():
         with self._lock:
             if self._wroking:
                 future = self.pool.submit(func, *args, **kwargs)
-                self.futures.append(future)
+                self.futures.add(future)
                 return future
             return None
 
@@ -24,7 +29,19 @@ class MyTheadingPool():
             e = future.exception()
             if e and logger:
                 logger.error(e)
-            self.futures.remove(future)
+            self.futures.discard(future)
+
+    def collect_done(self, logger: logging.Logger | None = None) -> int:
+        """移除已完成的任务，不等待，返回已完成的任务数
+        """
+        done = [future for future in self.futures if future.done()]
+        for future in done:
+            if not future.cancelled():
+                e = future.exception()
+                if e and logger:
+                    logger.error(e)
+            self.futures.discard(future)
+        return len(done)
 
     def close(self):
         self._stop_working()
@@ -34,4 +51,170 @@ class MyTheadingPool():
         with self._lock:
             self._wroking = False
         for future in self.futures:
-            future.cancel()
\ No newline at end of file
+            future.cancel()
+
+
+class MyCoordinator():
+    """在单独的线程中批量处理任务结果
+
+    工作线程只把结果放入队列，不做其他耗时操作，
+    队列中积累的结果会一次取出交给handler，handler可以合并同一批中的结果
+    """
+
+    _STOP = object()
+
+    def __init__(self, handler, batch_size: int = 100, on_batch=None, logger: logging.Logger | None = None) -> None:
+        """
+        Args:
+            handler (function): 处理函数，参数是结果列表
+            batch_size (int, optional): 每批最多处理的结果数. Defaults to 100.
+            on_batch (function, optional): 每批处理完后调用. Defaults to None.
+            logger (logging.Logger | None, optional): 记录handler的错误. Defaults to None.
+        """
+        self.queue = Queue()
+        self._handler = handler
+        self._batch_size = batch_size
+        self._on_batch = on_batch
+        self._logger = logger
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def idle(self) -> bool:
+        """队列中的结果是否都已处理完
+        """
+        return self.queue.unfinished_tasks == 0
+
+    def _run(self):
+        is_stop = False
+        while not is_stop:
+            batch = []
+            item = self.queue.get()
+            count = 1
+            if item is self._STOP:
+                is_stop = True
+            else:
+                batch.append(item)
+            while not is_stop and len(batch) < self._batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+                count += 1
+                if item is self._STOP:
+                    is_stop = True
+                else:
+                    batch.append(item)
+
+            try:
+                if batch:
+                    self._handler(batch)
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(e)
+            finally:
+                for _ in range(count):
+                    self.queue.task_done()
+                if self._on_batch:
+                    self._on_batch()
+
+    def close(self):
+        """处理完队列中的结果后结束线程
+        """
+        self.queue.put(self._STOP)
+        self._thread.join()
+
+
+def _ignore_sigint():
+    """子进程忽略ctrl+c，由主进程处理中断后关闭进程池
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class MyProcessPool():
+    """进程池，用于图片解码、还原、编码等CPU密集的任务
+
+    线程中的IO任务把数据交给进程池处理，不受GIL限制。
+    同时处理的任务数达到queue_size时，提交任务的线程会等待，
+    避免下载速度大于处理速度时，图片数据在内存中堆积。
+
+    有子进程异常退出(内存不足、解码崩溃)时，整个进程池都不能再使用，会重新创建；
+    没有任务成功就连续崩溃超过max_restarts次时不再重建，broken置为True，之后提交任务都会报错。
+    """
+
+    def __init__(self, max: int = 0, queue_size: int = 0, max_restarts: int = 3) -> None:
+        if max <= 0:
+            max = os.cpu_count() or 1
+        if queue_size <= 0:
+            queue_size = max * 2
+        self._max = max
+        self._max_restarts = max_restarts
+        self._restarts = 0  # 连续重建的次数，有任务成功时清零
+        self._pool_lock = Lock()
+        self.broken = False
+        self.pool = self._new_pool()
+        self._semaphore = BoundedSemaphore(queue_size)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # 使用spawn，避免在多线程的进程中fork
+        return ProcessPoolExecutor(max_workers=self._max,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_ignore_sigint)
+
+    def _restart(self, pool: ProcessPoolExecutor):
+        """pool已经损坏，重新创建进程池，多个线程同时发现时只重建一次
+        """
+        with self._pool_lock:
+            if pool is not self.pool or self.broken:
+                return
+            self._restarts += 1
+            if self._restarts > self._max_restarts:
+                self.broken = True
+                return
+            self.pool = self._new_pool()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _on_done(self, future: Future, pool: ProcessPoolExecutor):
+        self._semaphore.release()
+        if future.cancelled():
+            return
+        if isinstance(future.exception(), BrokenProcessPool):
+            self._restart(pool)
+        else:
+            self._restarts = 0
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        return self._submit(func, *args, **kwargs)[0]
+
+    def _submit(self, func, *args, **kwargs) -> tuple[Future, ProcessPoolExecutor]:
+        if self.broken:
+            raise BrokenProcessPool('进程池多次崩溃，无法恢复')
+        self._semaphore.acquire()
+        pool = self.pool
+        try:
+            future = pool.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            self._semaphore.release()
+            self._restart(pool)
+            raise
+        except Exception:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(lambda f: self._on_done(f, pool))
+        return future, pool
+
+    def run(self, func, *args, **kwargs):
+        """提交任务并等待结果
+        """
+        future, pool = self._submit(func, *args, **kwargs)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # 回调可能还没执行，返回前先重建，下一个任务不会提交到损坏的进程池
+            self._restart(pool)
+            raise
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
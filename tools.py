@@ -1,65 +1,184 @@
 import os
+import asyncio
 import functools
-import re
 from urllib.parse import urlparse
 import shutil
 from logging import Logger
 import time
+import random
+from threading import Lock
 
 
-def retry(times: int = 3, sleep: int = 0, logger: Logger = None):
+class RetryPolicy:
+    """重试策略，线程安全
+
+    永久错误(404等状态码)不重试，其他错误按指数退避加随机抖动等待后重试。
+    使用同一个策略的函数共享重试预算：每次重试消耗1，每次成功恢复budget_refill，
+    预算用完后只请求一次，服务器故障时不会让每个请求都重试数次。
+    """
+
+    # 重试也不会成功的状态码
+    PERMANENT_STATUS = frozenset((400, 401, 403, 404, 410))
+
+    def __init__(self,
+                 times: int = 3,
+                 base: float = 0,
+                 max_sleep: float = 30,
+                 budget: float = 100,
+                 budget_refill: float = 0.1,
+                 ) -> None:
+        """
+        Args:
+            times (int, optional): 最多执行次数. Defaults to 3.
+            base (float, optional): 第一次重试前的最大等待秒数，之后每次翻倍，0表示不等待. Defaults to 0.
+            max_sleep (float, optional): 最大等待秒数. Defaults to 30.
+            budget (float, optional): 重试预算. Defaults to 100.
+            budget_refill (float, optional): 每次成功恢复的预算. Defaults to 0.1.
+        """
+        self.times = times
+        self.base = base
+        self.max_sleep = max_sleep
+        self.max_budget = budget
+        self.budget_refill = budget_refill
+        self._budget = budget
+        self._lock = Lock()
+        self.counters = {'call': 0,  # 调用次数
+                         'success': 0,  # 成功次数
+                         'retry': 0,  # 重试次数
+                         'permanent': 0,  # 永久错误次数
+                         'exhausted': 0,  # 重试次数用完仍失败的次数
+                         'no_budget': 0,  # 预算不足放弃重试的次数
+                         }
+
+    def is_permanent(self, e: Exception) -> bool:
+        """是否是永久错误，只按请求错误(RequestError)的status_code判断，
+        其他异常可能是程序或数据问题，不能认为重试也不会成功
+        """
+        return getattr(e, 'status_code', None) in self.PERMANENT_STATUS
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次重试前的等待秒数，在0到退避上限之间随机取值
+        """
+        if not self.base:
+            return 0
+        return random.uniform(0, min(self.max_sleep, self.base * 2 ** attempt))
+
+    def count(self, key: str):
+        with self._lock:
+            self.counters[key] += 1
+
+    def allow_retry(self) -> bool:
+        """消耗一次重试预算，预算不足返回False
+        """
+        with self._lock:
+            if self._budget >= 1:
+                self._budget -= 1
+                self.counters['retry'] += 1
+                return True
+            self.counters['no_budget'] += 1
+            return False
+
+    def on_success(self):
+        with self._lock:
+            self.counters['success'] += 1
+            self._budget = min(self.max_budget, self._budget + self.budget_refill)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters, budget=round(self._budget, 1))
+
+
+def retry(times: int = 3, sleep: float = 0, logger: Logger = None, policy: RetryPolicy = None):
     """装饰器，实现重试功能
 
-    根据返回值判断是否重试
+    返回值为假或者发生临时错误时重试，永久错误直接失败，支持协程函数。
+    失败时，有logger记录日志并返回None，没有logger抛出最后一次的异常。
+
+    Args:
+        times (int, optional): 最多执行次数，提供policy时不使用. Defaults to 3.
+        sleep (float, optional): 退避等待的基数，提供policy时不使用. Defaults to 0.
+        logger (Logger, optional): 记录异常的日志. Defaults to None.
+        policy (RetryPolicy, optional): 重试策略，多个函数可以共享. Defaults to None.
     """
+    if policy is None:
+        policy = RetryPolicy(times=times, base=sleep)
+
+    def log_error(func, e, args, kwargs):
+        args_s = ",".join(map(str, args))
+        kwargs_s = ",".join(
+            f"{key}={value}" for key, value in kwargs.items())
+        logger.info(
+            f'[function]:{func.__name__},[args]:{args_s},[kwargs]:{kwargs_s},[Error]:{e}')
+
+    def next_sleep(func, attempt, e, args, kwargs):
+        """判断是否继续重试，返回等待秒数，不重试返回None
+        """
+        if e is not None:
+            if logger:
+                log_error(func, e, args, kwargs)
+            if policy.is_permanent(e):
+                policy.count('permanent')
+                return None
+        if attempt + 1 >= policy.times:
+            policy.count('exhausted')
+            return None
+        if not policy.allow_retry():
+            return None
+        return policy.backoff(attempt)
+
+    def finish(res, e):
+        if e is not None and not logger:
+            raise e
+        return res
+
     def wrapper1(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper2(*args, **kwargs):
+                policy.count('call')
+                attempt = 0
+                while True:
+                    res, err = None, None
+                    try:
+                        res = await func(*args, **kwargs)
+                    except Exception as e:
+                        err = e
+                    if res:
+                        policy.on_success()
+                        return res
+                    wait = next_sleep(func, attempt, err, args, kwargs)
+                    if wait is None:
+                        return finish(res, err)
+                    if wait:
+                        await asyncio.sleep(wait)
+                    attempt += 1
+            return async_wrapper2
+
         @functools.wraps(func)
         def wrapper2(*args, **kwargs):
-            count = 0
-            while count < times:
+            policy.count('call')
+            attempt = 0
+            while True:
+                res, err = None, None
                 try:
                     res = func(*args, **kwargs)
                 except Exception as e:
-                    res = None
-                    if logger:
-                        args_s = ",".join(map(str, args))
-                        kwargs_s = ",".join(
-                            f"{key}={value}" for key, value in kwargs.items())
-                        logger.info(
-                            f'[function]:{func.__name__},[args]:{args_s},[kwargs]:{kwargs_s},[Error]:{e}')
-                    else:
-                        raise e
-                    if sleep:
-                        time.sleep(sleep)
+                    err = e
                 if res:
-                    break
-                count += 1
-            return res
+                    policy.on_success()
+                    return res
+                wait = next_sleep(func, attempt, err, args, kwargs)
+                if wait is None:
+                    return finish(res, err)
+                if wait:
+                    time.sleep(wait)
+                attempt += 1
         return wrapper2
     return wrapper1
 
 
-def count_sleep(func):
-    '''装饰器，统计函数调用次数，到达次数会进行休眠数秒
-
-    累计5次下载,休眠1秒
-    '''
-    count = 0
-    MAX = 5
-    SLEEP = 1
-
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        nonlocal count, MAX
-
-        if count >= MAX:
-            time.sleep(SLEEP)
-            count = 0
-
-        res = func(*args, **kwargs)
-        count += 1
-        return res
-    return wrapper
+_FILENAME_TABLE = str.maketrans({'\\': '、', '/': '、', ':': '：', '*': '',
+                                '?': '？', '"': '“', '<': '《', '>': '》', '|': '丨'})
 
 
 def get_efficacious_filename(filename: str) -> str:
@@ -67,11 +186,7 @@ def get_efficacious_filename(filename: str) -> str:
 
     中文双引号有闭合的，先不管，都用一种
     """
-    char_dict = {'\\': '、', '/': '、', ':': '：', '*': '',
-                 '?': '？', '"': '“', '<': '《', '>': '》', '|': '丨'}
-    for i, j in char_dict.items():
-        filename = re.sub(re.escape(i), j, filename)
-    return filename
+    return filename.translate(_FILENAME_TABLE)
 
 
 def url_to_filename(url):